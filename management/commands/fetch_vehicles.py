@@ -2,55 +2,206 @@ from django.core.management.base import BaseCommand
 import zoneinfo
 from django.db import IntegrityError
 from timepred.models import RawVehicleData, VehicleCache
-from typing import Dict
 import logging
 
+from timepred.processing import metrics
+from timepred.processing.bulk import copy_insert
 from timepred.processing.constants import WROCLAW_TZ
+from timepred.processing.projection import to_utm
 
 logging.basicConfig(level=logging.DEBUG)
 
 import datetime
+import numpy as np
+import pandas as pd
+import queue
 import random
 import requests
+import threading
 import time
 import warnings
+import urllib.parse
 import timepred.processing.present as present
+from django.core.cache import cache
 from timepred.processing.present import process_many_data
 
-present.init(True)
-
 import cProfile
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
 
-URL = "https://www.wroclaw.pl/open-data/api/action/datastore_search?resource_id=17308285-3977-42f7-81b7-fdd168c210a2"
+API_URL = "https://www.wroclaw.pl/open-data/api/action"
+RESOURCE_ID = "17308285-3977-42f7-81b7-fdd168c210a2"
+URL = f"{API_URL}/datastore_search?resource_id={RESOURCE_ID}"
+SQL_URL = f"{API_URL}/datastore_search_sql"
+
+WATERMARK_CACHE_KEY = "timepred:fetch_vehicles:watermark"
+# an incremental fetch returning this many records may have been truncated
+INCREMENTAL_LIMIT = 5000
+# if the watermark is older than this, we may have missed updates
+MAX_WATERMARK_LAG = datetime.timedelta(minutes=1)
+# resynchronize with a full snapshot every this many incremental fetches
+FULL_SNAPSHOT_EVERY = 60
+
+POLL_INTERVAL = datetime.timedelta(seconds=5)
+# snapshots waiting for the processing stage; older ones get merged into newer
+PIPELINE_QUEUE_SIZE = 2
+
+RECORD_COLUMNS = [
+    "Nr_Boczny",
+    "Brygada",
+    "Nazwa_Linii",
+    "Ostatnia_Pozycja_Szerokosc",
+    "Ostatnia_Pozycja_Dlugosc",
+    "Data_Aktualizacji",
+]
+
+# a snapshot holds the newest record of every vehicle, indexed by vehicle_id,
+# with the columns of RawVehicleData
+Snapshot = pd.DataFrame
 
 
 def sleep_until(t: datetime.datetime):
     time.sleep(max(0, (t - datetime.datetime.now()).total_seconds()))
 
 
+def empty_snapshot() -> Snapshot:
+    return pd.DataFrame(
+        {
+            "route_id": pd.Series(dtype=object),
+            "brigade_id": pd.Series(dtype=np.int16),
+            "route_name": pd.Series(dtype=object),
+            "latitude": pd.Series(dtype=np.float64),
+            "longitude": pd.Series(dtype=np.float64),
+            "timestamp": pd.Series(dtype=f"datetime64[ns, {WROCLAW_TZ.key}]"),
+        },
+        index=pd.Index([], dtype=np.int64, name="vehicle_id"),
+    )
+
+
+def merge_snapshots(older: Snapshot, newer: Snapshot) -> Snapshot:
+    merged = pd.concat([older, newer]) if len(older) > 0 else newer
+    merged = merged.sort_values("timestamp", kind="stable")
+    return merged[~merged.index.duplicated(keep="last")]
+
+
+def is_valid(snapshot: Snapshot) -> "pd.Series[bool]":
+    # vectorized version of present.is_valid
+    return (
+        (snapshot["route_name"] != "")
+        & snapshot["latitude"].between(-90.0, 90.0)
+        & snapshot["longitude"].between(-180.0, 180.0)
+    )
+
+
+def to_raw_vehicle_data(snapshot: Snapshot) -> list[RawVehicleData]:
+    valid = is_valid(snapshot)
+    # the whole snapshot is projected at once, workers use rd.x and rd.y
+    x, y = to_utm(
+        snapshot["longitude"].to_numpy(dtype=np.float64),
+        snapshot["latitude"].to_numpy(dtype=np.float64),
+    )
+    rds = [
+        RawVehicleData(
+            vehicle_id=vehicle_id,
+            route_id=route_id,
+            brigade_id=brigade_id,
+            route_name=route_name,
+            latitude=latitude,
+            longitude=longitude,
+            timestamp=timestamp,
+            # invalid records are stored, but never reach the workers
+            processed=not v,
+        )
+        for vehicle_id, route_id, brigade_id, route_name, latitude, longitude, timestamp, v in zip(
+            snapshot.index.tolist(),
+            snapshot["route_id"].tolist(),
+            snapshot["brigade_id"].tolist(),
+            snapshot["route_name"].tolist(),
+            snapshot["latitude"].tolist(),
+            snapshot["longitude"].tolist(),
+            [t.to_pydatetime() for t in snapshot["timestamp"]],
+            valid.tolist(),
+        )
+    ]
+    for rd, rx, ry in zip(rds, x.tolist(), y.tolist()):
+        rd.x = rx  # type: ignore
+        rd.y = ry  # type: ignore
+    return rds
+
+
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--pipelined",
+            action="store_true",
+            help="fetch snapshots on schedule in a separate thread and process only the newest one",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="only fetch records updated after the last seen Data_Aktualizacji",
+        )
+
     def handle(self, *args, **options):
+        present.init(True)
+
+        self.session = requests.Session()
+        self.incremental = options["incremental"]
+        self.watermark: str | None = cache.get(WATERMARK_CACHE_KEY)
+        self.fetches_since_full = 0
         # cProfile.runctx("self._handle()", globals(), locals(), "profil")
-        self._handle()
+        if options["pipelined"]:
+            self._handle_pipelined()
+        else:
+            self._handle()
 
-    def _handle(self, *args, **options):
-        last_raw_data: dict[int, RawVehicleData] = {
-            rd.vehicle_id: rd
-            for rd in RawVehicleData.objects.filter(
+    def get_last_raw_data(self) -> Snapshot:
+        rows = list(
+            RawVehicleData.objects.filter(
                 timestamp__gte=datetime.datetime.now(WROCLAW_TZ)
                 - datetime.timedelta(minutes=5)
             )
             .order_by("vehicle_id", "-timestamp")
             .distinct("vehicle_id")
-        }
+            .values_list(
+                "vehicle_id",
+                "route_id",
+                "brigade_id",
+                "route_name",
+                "latitude",
+                "longitude",
+                "timestamp",
+            )
+        )
+        if len(rows) == 0:
+            return empty_snapshot()
+
+        snapshot = pd.DataFrame.from_records(
+            rows,
+            columns=[
+                "vehicle_id",
+                "route_id",
+                "brigade_id",
+                "route_name",
+                "latitude",
+                "longitude",
+                "timestamp",
+            ],
+            index="vehicle_id",
+        )
+        snapshot["timestamp"] = pd.to_datetime(snapshot["timestamp"]).dt.tz_convert(
+            WROCLAW_TZ
+        )
+        return snapshot
+
+    def _handle(self, *args, **options):
+        last_raw_data = self.get_last_raw_data()
         while True:
             start_time = datetime.datetime.now()
             logging.debug(f"Start time: {start_time}")
 
-            next_loop_time = start_time + datetime.timedelta(seconds=5)
+            next_loop_time = start_time + POLL_INTERVAL
 
             raw_data = self.get_raw_data()
             if raw_data is None:
@@ -58,40 +209,148 @@ class Command(BaseCommand):
                 sleep_until(next_loop_time)
                 continue
 
-            updated_raw_data = self.get_updated_data(last_raw_data, raw_data)
-            logging.info(f"len(updated_data): {len(updated_raw_data)}")
-            RawVehicleData.objects.bulk_create(updated_raw_data.values())
+            self.process_snapshot(last_raw_data, raw_data)
 
-            process_many_data(updated_raw_data.values())
+            end_time = datetime.datetime.now()
+            logging.debug(f"End time: {end_time}")
+            logging.info(f"Elapsed: {end_time - start_time}")
 
-            VehicleCache.objects.filter(
-                timestamp__lt=datetime.datetime.now(WROCLAW_TZ)
-                - datetime.timedelta(minutes=5)
-            ).delete()
+            last_raw_data = merge_snapshots(last_raw_data, raw_data)
+
+            sleep_until(next_loop_time)
+
+    def _handle_pipelined(self):
+        last_raw_data = self.get_last_raw_data()
+        snapshots: "queue.Queue[Snapshot]" = queue.Queue(PIPELINE_QUEUE_SIZE)
+        fetcher = threading.Thread(
+            target=self.fetch_loop, args=(snapshots,), daemon=True
+        )
+        fetcher.start()
+
+        while True:
+            raw_data = snapshots.get()
+            skipped = 0
+            while True:
+                try:
+                    raw_data = merge_snapshots(raw_data, snapshots.get_nowait())
+                    skipped += 1
+                except queue.Empty:
+                    break
+            if skipped > 0:
+                logging.info(f"processing is late, merged {skipped} snapshots")
+
+            start_time = datetime.datetime.now()
+            logging.debug(f"Start time: {start_time}")
+
+            self.process_snapshot(last_raw_data, raw_data)
 
             end_time = datetime.datetime.now()
             logging.debug(f"End time: {end_time}")
             logging.info(f"Elapsed: {end_time - start_time}")
+            if end_time - start_time > POLL_INTERVAL:
+                logging.warning(
+                    f"processing took longer than the poll interval: {end_time - start_time}"
+                )
+
+            last_raw_data = merge_snapshots(last_raw_data, raw_data)
+
+    def fetch_loop(self, snapshots: "queue.Queue[Snapshot]"):
+        next_loop_time = datetime.datetime.now()
+        while True:
+            next_loop_time += POLL_INTERVAL
+            # don't try to catch up on cycles we have already missed
+            if next_loop_time < datetime.datetime.now():
+                next_loop_time = datetime.datetime.now() + POLL_INTERVAL
+
+            raw_data = self.get_raw_data()
+            if raw_data is None:
+                logging.debug("raw_data is None")
+                sleep_until(next_loop_time)
+                continue
 
-            last_raw_data = raw_data
+            try:
+                snapshots.put_nowait(raw_data)
+            except queue.Full:
+                # this is the only producer, so after taking the oldest
+                # snapshot out there is always room for the merged one
+                try:
+                    raw_data = merge_snapshots(snapshots.get_nowait(), raw_data)
+                except queue.Empty:
+                    pass
+                snapshots.put_nowait(raw_data)
+                logging.debug("snapshot queue full, merged oldest snapshot")
 
             sleep_until(next_loop_time)
 
-    def get_updated_data(
-        self, old_data: dict[int, RawVehicleData], new_data: dict[int, RawVehicleData]
-    ) -> dict[int, RawVehicleData]:
-        return {
-            k: new_data[k]
-            for k in new_data
-            if k not in old_data
-            or old_data[k].timestamp < new_data[k].timestamp
-            and datetime.datetime.now(WROCLAW_TZ) - new_data[k].timestamp
-            <= datetime.timedelta(minutes=5)
-        }
-
-    def get_raw_data(self) -> Dict[int, RawVehicleData] | None:
+    @metrics.timed("cycle")
+    def process_snapshot(self, last_raw_data: Snapshot, raw_data: Snapshot):
+        updated_raw_data = to_raw_vehicle_data(
+            self.get_updated_data(last_raw_data, raw_data)
+        )
+        logging.info(f"len(updated_data): {len(updated_raw_data)}")
+        metrics.count("records", len(updated_raw_data))
+        with metrics.timer("bulk_create"):
+            copy_insert(updated_raw_data)
+
+        process_many_data([rd for rd in updated_raw_data if not rd.processed])
+
+        present.delete_stale_vehicles(
+            datetime.datetime.now(WROCLAW_TZ) - datetime.timedelta(minutes=5)
+        )
+        metrics.publish()
+
+    def get_updated_data(self, old_data: Snapshot, new_data: Snapshot) -> Snapshot:
+        # a record is identified by (vehicle_id, timestamp), the ones with a
+        # timestamp no newer than the last seen one of their vehicle are dropped
+        old_timestamp = old_data["timestamp"].reindex(new_data.index)
+        is_new = old_timestamp.isna()
+        is_recent = datetime.datetime.now(WROCLAW_TZ) - new_data[
+            "timestamp"
+        ] <= pd.Timedelta(minutes=5)
+        return new_data[is_new | (old_timestamp < new_data["timestamp"]) & is_recent]
+
+    def get_raw_data(self) -> Snapshot | None:
+        if self.incremental and not self.needs_full_snapshot():
+            records = self.get_records(self.get_incremental_url())
+            if records is not None and len(records) >= INCREMENTAL_LIMIT:
+                logging.info("incremental fetch may be truncated, fetching all")
+                records = None
+            if records is not None:
+                self.fetches_since_full += 1
+                return self.parse_records(records)
+
+        records = self.get_records(self.get_url())
+        if records is None:
+            return None
+        self.fetches_since_full = 0
+        return self.parse_records(records)
+
+    def needs_full_snapshot(self) -> bool:
+        if self.watermark is None or self.fetches_since_full >= FULL_SNAPSHOT_EVERY:
+            return True
+
+        try:
+            watermark_time = datetime.datetime.fromisoformat(self.watermark).replace(
+                tzinfo=WROCLAW_TZ
+            )
+        except ValueError:
+            return True
+
+        return datetime.datetime.now(WROCLAW_TZ) - watermark_time > MAX_WATERMARK_LAG
+
+    def update_watermark(self, updated_at: "pd.Series[str]"):
+        if len(updated_at) == 0:
+            return
+
+        watermark = updated_at.max()
+        if self.watermark is None or self.watermark < watermark:
+            self.watermark = watermark
+            cache.set(WATERMARK_CACHE_KEY, watermark, None)
+
+    @metrics.timed("fetch")
+    def get_records(self, url: str) -> list[dict] | None:
         try:
-            response = requests.get(self.get_url())
+            response = self.session.get(url, timeout=10)
         except:
             return None
         if response.status_code != 200:
@@ -110,35 +369,60 @@ class Command(BaseCommand):
             logging.error(f"Request failed. response.text == {response.text}")
             return None
 
-        records = data["result"]["records"]
-        cur_data = {
-            p.vehicle_id: p for r in records if (p := self.parse_record(r)) is not None
-        }
+        return data["result"]["records"]
 
-        del data["result"]["records"]
-        logging.info(f"get_raw_data: {len(records)} records, {len(cur_data)} parsed")
+    @metrics.timed("parse")
+    def parse_records(self, records: list[dict]) -> Snapshot:
+        frame = pd.DataFrame.from_records(records, columns=RECORD_COLUMNS)
+        self.update_watermark(frame["Data_Aktualizacji"].dropna().astype(str))
 
-        return cur_data
+        brigade = frame["Brygada"].astype(str)
+        vehicle_id = pd.to_numeric(frame["Nr_Boczny"], errors="coerce")
+        brigade_id = pd.to_numeric(brigade.str[-2:], errors="coerce")
+        parsed = vehicle_id.notna() & brigade_id.notna()
 
-    def parse_record(self, record) -> RawVehicleData | None:
-        timestamp = record["Data_Aktualizacji"]
-        if "." not in timestamp:
-            timestamp = timestamp + ".0"
-        timestamp = datetime.datetime.strptime(
-            timestamp, "%Y-%m-%d %H:%M:%S.%f"
-        ).replace(tzinfo=WROCLAW_TZ)
-        try:
-            return RawVehicleData(
-                vehicle_id=int(record["Nr_Boczny"]),
-                route_id=record["Brygada"][:-2],
-                brigade_id=int(record["Brygada"][-2:]),
-                route_name=record["Nazwa_Linii"],
-                latitude=record["Ostatnia_Pozycja_Szerokosc"],
-                longitude=record["Ostatnia_Pozycja_Dlugosc"],
-                timestamp=timestamp,
-            )
-        except ValueError:
-            return None
+        snapshot = pd.DataFrame(
+            {
+                "route_id": brigade.str[:-2],
+                "brigade_id": brigade_id,
+                "route_name": frame["Nazwa_Linii"],
+                "latitude": pd.to_numeric(
+                    frame["Ostatnia_Pozycja_Szerokosc"], errors="coerce"
+                ),
+                "longitude": pd.to_numeric(
+                    frame["Ostatnia_Pozycja_Dlugosc"], errors="coerce"
+                ),
+                "timestamp": pd.to_datetime(
+                    frame["Data_Aktualizacji"], format="ISO8601", errors="coerce"
+                ).dt.tz_localize(
+                    WROCLAW_TZ, ambiguous=True, nonexistent="shift_forward"
+                ),
+            }
+        )
+        parsed &= snapshot["timestamp"].notna()
+        snapshot = snapshot[parsed].astype({"brigade_id": np.int16})
+        snapshot.index = pd.Index(
+            vehicle_id[parsed].astype(np.int64), name="vehicle_id"
+        )
+        snapshot = snapshot.sort_values("timestamp", kind="stable")
+        snapshot = snapshot[~snapshot.index.duplicated(keep="last")]
+
+        logging.info(f"get_raw_data: {len(records)} records, {len(snapshot)} parsed")
+
+        return snapshot
 
     def get_url(self) -> str:
         return URL + f"&limit={random.randint(1000, 15000)}"
+
+    def get_incremental_url(self) -> str:
+        assert self.watermark is not None
+        watermark = self.watermark.replace("'", "''")
+        # records sharing the watermark's timestamp can arrive after it was
+        # taken, so they are fetched again and get_updated_data drops those
+        # already seen
+        sql = (
+            f'SELECT * FROM "{RESOURCE_ID}"'
+            f""" WHERE "Data_Aktualizacji" >= '{watermark}'"""
+            f' ORDER BY "Data_Aktualizacji" LIMIT {INCREMENTAL_LIMIT}'
+        )
+        return SQL_URL + "?" + urllib.parse.urlencode({"sql": sql})
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import logging
+
+from timepred.processing.partitions import apply_retention, ensure_partitions
+
+logging.basicConfig(level=logging.INFO)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=3,
+            help="create daily partitions for this many days after today",
+        )
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=getattr(settings, "TIMEPRED_RAW_RETENTION_DAYS", None),
+            help="drop raw data older than this many days",
+        )
+        parser.add_argument(
+            "--rollup-interval",
+            type=int,
+            default=getattr(settings, "TIMEPRED_RAW_ROLLUP_INTERVAL", None),
+            help="before dropping raw data, keep one averaged position per vehicle per this many seconds",
+        )
+
+    def handle(self, *args, **options):
+        ensure_partitions(options["ahead"])
+
+        if options["retention_days"] is not None:
+            apply_retention(options["retention_days"], options["rollup_interval"])
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from timepred.processing.metrics import collect
+
+
+def format_seconds(s: float | None) -> str:
+    if s is None:
+        return "-"
+    return f"{s * 1000:.1f}ms"
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        metrics = collect()
+
+        self.stdout.write(
+            f"{'stage':<24}{'count':>10}{'total':>12}{'mean':>12}{'p50':>12}{'p95':>12}{'max':>12}"
+        )
+        for name, stage in metrics["stages"].items():
+            self.stdout.write(
+                f"{name:<24}{stage['count']:>10}{stage['total']:>11.1f}s"
+                + "".join(
+                    f"{format_seconds(stage[k]):>12}"
+                    for k in ["mean", "p50", "p95", "max"]
+                )
+            )
+
+        self.stdout.write("")
+        for name, value in sorted(metrics["counters"].items()):
+            self.stdout.write(f"{name:<24}{value:>10.0f}")
+        for name, value in sorted(metrics["gauges"].items()):
+            self.stdout.write(f"{name:<24}{value:>10.0f}")
+
+        self.stdout.write("")
+        for pid, worker in sorted(metrics["workers"].items()):
+            self.stdout.write(
+                f"worker {pid:<17}{worker['records']:>10}{worker['utilization'] * 100:>11.1f}%"
+            )
@@ -11,60 +11,64 @@ import warnings
 
 warnings.filterwarnings(category=RuntimeWarning, action="ignore")
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import IntegrityError
-from django.db.models import Q
 
-from timepred.models import RawVehicleData, VehicleCache
+from timepred.processing.backfill import (
+    backfill,
+    get_first_unprocessed_day,
+    restart_days,
+)
+from timepred.processing.constants import WROCLAW_TZ
 import timepred.processing.present as present
-import timepred.processing.future as future
-from timepred.processing.present import process_many_data
 
 present.STRATEGY = NullStrategy()
-present.init(False)
-
-BATCH_SIZE = 5000
 
 
 class Command(BaseCommand):
-    def handle(self, *args, **options):
-        # fmt: off
-        unprocessed = (
-            RawVehicleData.objects
-            .filter(~Q(route_name=''), processed=False, timestamp__gte='2024-01-15 23:00:00+01:00')
-            .order_by("timestamp")
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start",
+            type=datetime.date.fromisoformat,
+            help="first service day to process, defaults to the earliest unprocessed one",
+        )
+        parser.add_argument(
+            "--end",
+            type=datetime.date.fromisoformat,
+            help="last service day to process, defaults to today",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=getattr(settings, "TIMEPRED_NPROC", 2),
+            help="number of service days processed in parallel",
+        )
+        parser.add_argument(
+            "--day-start-hour",
+            type=int,
+            default=3,
+            help="hour at which a service day starts",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="process the days again, replacing the trip instances made before",
         )
-        # fmt: on
-        N = unprocessed.count()
-        i = 0
-        print()
-        start_time = None
-        batch = []
-        for rd in unprocessed.iterator(chunk_size=50000):
-            batch.append(rd)
-
-            if len(batch) < BATCH_SIZE:
-                continue
-
-            if start_time is None:
-                start_time = datetime.datetime.now()
-
-            results = process_many_data(batch)
-            batch = []
-
-            i += len(results)
-            avg = (datetime.datetime.now() - start_time).total_seconds() / i
-            remaining = datetime.timedelta(seconds=(N - i) * avg)
-            print(
-                f"\033[F\r{i}/{N}  {1/avg:.2f}/s  ETA:{remaining} {' '*10}",
-                file=sys.stderr,
-            )
-
-            print(
-                f"\r{results.count(None)} / {len(results)}{' '*30}",
-                end="",
-                file=sys.stderr,
-            )
 
-        if len(batch) > 0:
-            process_many_data(batch)
+    def handle(self, *args, **options):
+        day_start_hour = options["day_start_hour"]
+
+        start = options["start"] or get_first_unprocessed_day(day_start_hour)
+        if start is None:
+            logging.info("nothing to process")
+            return
+        end = options["end"] or datetime.datetime.now(WROCLAW_TZ).date()
+
+        days = [
+            start + datetime.timedelta(days=i) for i in range((end - start).days + 1)
+        ]
+        if options["restart"]:
+            restart_days(days, day_start_hour)
+
+        present.init_local(False)
+        backfill(days, options["jobs"], day_start_hour)
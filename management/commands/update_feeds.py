@@ -8,6 +8,14 @@ import gtfs_kit as gk
 from multigtfs.models.feed import Feed
 import requests
 from multigtfs.models.feed_info import FeedInfo
+from timepred.processing.cache import bump_feed_generation
+from timepred.processing.display import build_display_geometries
+from timepred.processing.patterns import build_missing_patterns, build_patterns
+from timepred.processing.service_calendar import (
+    build_missing_service_calendars,
+    build_service_calendar,
+)
+from timepred.processing.snapshot import write_snapshot
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -25,11 +33,16 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
+        # feeds imported before patterns existed
+        if build_missing_patterns() + build_missing_service_calendars() > 0:
+            bump_feed_generation()
+        build_display_geometries()
+
         feed_urls = self.get_feed_urls()
         for feed_url in feed_urls:
             filename = self.download_feed(feed_url)
             if filename is None:
-                return
+                break
 
             feed = gk.read_feed(Path(filename), dist_units="km")
             feed_start_date: date = gk.helpers.datestr_to_date(
@@ -49,6 +62,10 @@ class Command(BaseCommand):
                 name = feed_start_date or str(date.today())
                 feed = Feed.objects.create(name=name)
                 feed.import_gtfs(filename)
+                build_patterns(feed)
+                build_service_calendar(feed)
+                build_display_geometries(feed)
+                bump_feed_generation()
             else:
                 logging.debug("and already have that feed")
 
@@ -59,6 +76,8 @@ class Command(BaseCommand):
             if feed_start_date <= datetime.now(WROCLAW_TZ).date():
                 break
 
+        write_snapshot()
+
     def download_feed(self, url: str) -> str | None:
         filename = url.split("/")[-1]
         logging.debug(f"{filename}...")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from timepred.processing.snapshot import write_snapshot
+
+
+class Command(BaseCommand):
+    # update_feeds writes one after every import, this keeps the days it
+    # covers current when run daily
+    def handle(self, *args, **options):
+        write_snapshot()
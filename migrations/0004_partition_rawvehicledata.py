@@ -0,0 +1,108 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+PARTITION_RAWVEHICLEDATA = """
+DO $$
+DECLARE
+    r record;
+    max_id bigint;
+    bound timestamptz;
+BEGIN
+    ALTER TABLE timepred_rawvehicledata RENAME TO timepred_rawvehicledata_legacy;
+    ALTER TABLE timepred_rawvehicledata_legacy DROP CONSTRAINT timepred_rawvehicledata_pkey;
+    ALTER TABLE timepred_rawvehicledata_legacy ALTER COLUMN id DROP IDENTITY IF EXISTS;
+    FOR r IN
+        SELECT indexname FROM pg_indexes
+        WHERE tablename = 'timepred_rawvehicledata_legacy' AND indexdef LIKE '%(processed)%'
+    LOOP
+        EXECUTE format('DROP INDEX %I', r.indexname);
+    END LOOP;
+
+    SELECT max(id), greatest(max("timestamp"), now()) INTO max_id, bound
+    FROM timepred_rawvehicledata_legacy;
+    bound := (date_trunc('day', bound AT TIME ZONE 'Europe/Warsaw') + interval '1 day')
+        AT TIME ZONE 'Europe/Warsaw';
+
+    CREATE TABLE timepred_rawvehicledata (
+        LIKE timepred_rawvehicledata_legacy INCLUDING DEFAULTS,
+        PRIMARY KEY (id, "timestamp")
+    ) PARTITION BY RANGE ("timestamp");
+    CREATE SEQUENCE timepred_rawvehicledata_id_seq OWNED BY timepred_rawvehicledata.id;
+    ALTER TABLE timepred_rawvehicledata
+        ALTER COLUMN id SET DEFAULT nextval('timepred_rawvehicledata_id_seq');
+    PERFORM setval('timepred_rawvehicledata_id_seq', coalesce(max_id, 0) + 1, false);
+
+    CREATE INDEX timepred_raw_timestamp_idx ON timepred_rawvehicledata ("timestamp");
+    CREATE INDEX timepred_raw_route_id_idx ON timepred_rawvehicledata (route_id);
+    CREATE INDEX timepred_raw_brigade_id_idx ON timepred_rawvehicledata (brigade_id);
+
+    -- everything collected so far stays in one partition, new data goes
+    -- into daily partitions created by the partition_raw_data command
+    EXECUTE format(
+        'ALTER TABLE timepred_rawvehicledata ATTACH PARTITION timepred_rawvehicledata_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        bound
+    );
+    CREATE TABLE timepred_rawvehicledata_default
+        PARTITION OF timepred_rawvehicledata DEFAULT;
+END $$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("timepred", "0003_alter_averagetraveltime_from_stop_code_and_more"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="vehiclecache",
+            name="raw",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="timepred.rawvehicledata",
+            ),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunSQL(PARTITION_RAWVEHICLEDATA)],
+            state_operations=[
+                migrations.AlterField(
+                    model_name="rawvehicledata",
+                    name="processed",
+                    field=models.BooleanField(default=False),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="rawvehicledata",
+            index=models.Index(
+                condition=models.Q(("processed", False)),
+                fields=["timestamp"],
+                name="timepred_raw_unprocessed_idx",
+            ),
+        ),
+        migrations.CreateModel(
+            name="RawVehicleDataRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("vehicle_id", models.SmallIntegerField()),
+                ("route_id", models.CharField(max_length=5)),
+                ("route_name", models.CharField(max_length=5, null=True)),
+                ("brigade_id", models.SmallIntegerField()),
+                ("timestamp", models.DateTimeField(db_index=True)),
+                ("latitude", models.FloatField()),
+                ("longitude", models.FloatField()),
+                ("count", models.IntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,72 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multigtfs", "0001_initial"),
+        ("timepred", "0005_backfillcheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TripPattern",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=64)),
+                ("geometry_hash", models.CharField(max_length=32)),
+                (
+                    "feed",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="multigtfs.feed",
+                    ),
+                ),
+                (
+                    "trip",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="multigtfs.trip",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("feed", "key"), name="timepred_trippattern_feed_key"
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="PatternTrip",
+            fields=[
+                (
+                    "trip",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="multigtfs.trip",
+                    ),
+                ),
+                (
+                    "pattern",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="timepred.trippattern",
+                    ),
+                ),
+            ],
+        ),
+    ]
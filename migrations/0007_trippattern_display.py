@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("timepred", "0006_trippattern"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="trippattern",
+            name="display",
+            field=models.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multigtfs", "0001_initial"),
+        ("timepred", "0007_trippattern_display"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ServiceDay",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(db_index=True)),
+                ("service_ids", models.JSONField()),
+                (
+                    "feed",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="multigtfs.feed",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("feed", "date"), name="timepred_serviceday_feed_date"
+                    )
+                ],
+            },
+        ),
+    ]
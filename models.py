@@ -5,6 +5,7 @@ from django.utils import timezone
 from typing import Any, ClassVar, Self
 from django.contrib.gis.db import models as gis
 from django.db import DEFAULT_DB_ALIAS, connection, models
+from multigtfs.models.feed import Feed
 from multigtfs.models.route import Route
 from multigtfs.models.stop_time import StopTime
 from multigtfs.models.trip import Trip
@@ -84,6 +85,8 @@ class StopTimePrediction(models.Model):
 
 
 class RawVehicleData(models.Model):
+    # The table is range partitioned by day on timestamp, see
+    # timepred.processing.partitions. Queries should filter on timestamp.
     vehicle_id = models.SmallIntegerField()
     route_id = models.CharField(max_length=5, db_index=True)
     route_name = models.CharField(max_length=5, null=True)
@@ -91,7 +94,16 @@ class RawVehicleData(models.Model):
     timestamp = models.DateTimeField(db_index=True)
     latitude = models.FloatField()
     longitude = models.FloatField()
-    processed = models.BooleanField(default=False, db_index=True)
+    processed = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["timestamp"],
+                condition=models.Q(processed=False),
+                name="timepred_raw_unprocessed_idx",
+            )
+        ]
 
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
@@ -110,6 +122,19 @@ class RawVehicleData(models.Model):
         return f"R{self.pk}-{self.vehicle_id}-{self.route_id}{self.brigade_id}-{self.route_name}-{self.timestamp}"
 
 
+class RawVehicleDataRollup(models.Model):
+    # RawVehicleData downsampled to one averaged position per vehicle per
+    # interval, kept after the raw partitions are dropped
+    vehicle_id = models.SmallIntegerField()
+    route_id = models.CharField(max_length=5)
+    route_name = models.CharField(max_length=5, null=True)
+    brigade_id = models.SmallIntegerField()
+    timestamp = models.DateTimeField(db_index=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    count = models.IntegerField()
+
+
 class VehicleStopTime(models.Model):
     id: int
     trip_instance_id: int
@@ -157,7 +182,10 @@ class VehicleCache(models.Model):
     next_stoptime = models.ForeignKey(StopTime, on_delete=models.CASCADE)
     position = gis.PointField()
     timestamp = models.DateTimeField(db_index=True)
-    raw = models.ForeignKey(RawVehicleData, on_delete=models.CASCADE)
+    # partitioned tables can't be referenced by a foreign key on id alone
+    raw = models.ForeignKey(
+        RawVehicleData, on_delete=models.CASCADE, db_constraint=False
+    )
     shape_dist = models.FloatField()
     current_vehiclestoptime = models.ForeignKey(
         VehicleStopTime, on_delete=models.SET_NULL, null=True
@@ -176,3 +204,63 @@ class VehicleCache(models.Model):
 
     def __str__(self) -> str:
         return f"C{self.vehicle_id}-{self.shape_dist:.0f}m-[{self.trip_instance.id}:{self.trip_id}-{self.next_stoptime_id}]"
+
+
+class BackfillCheckpoint(models.Model):
+    # progress of process_raw_data for one service day
+    day = models.DateField(unique=True)
+    last_timestamp = models.DateTimeField(null=True)
+    finished = models.BooleanField(default=False)
+
+    def __str__(self) -> str:
+        return (
+            f"B{self.day}-{self.last_timestamp}{'-finished' if self.finished else ''}"
+        )
+
+
+class TripPattern(models.Model):
+    # trips of a feed with the same geometry and the same stops
+    id: int
+    trip_id: int
+
+    feed = models.ForeignKey(Feed, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)
+    geometry_hash = models.CharField(max_length=32)
+    # the trip geometry is read from
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name="+")
+    # see timepred.processing.display
+    display = models.JSONField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["feed", "key"], name="timepred_trippattern_feed_key"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"P{self.id}-{self.key[:8]}"
+
+
+class PatternTrip(models.Model):
+    pattern_id: int
+
+    trip = models.OneToOneField(Trip, on_delete=models.CASCADE, primary_key=True)
+    pattern = models.ForeignKey(TripPattern, on_delete=models.CASCADE)
+
+
+class ServiceDay(models.Model):
+    # services of a feed running on a date, see processing.service_calendar
+    feed = models.ForeignKey(Feed, on_delete=models.CASCADE)
+    date = models.DateField(db_index=True)
+    service_ids = models.JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["feed", "date"], name="timepred_serviceday_feed_date"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"S{self.feed_id}-{self.date}"  # type: ignore
@@ -8,6 +8,7 @@ from timepred.models import StopPrediction, StopTimePrediction, VehicleStopTime
 import tqdm
 from functools import partial
 
+from timepred.processing.bulk import copy_insert
 from timepred.processing.future.strategy import EstimationStrategy
 import timepred.processing.future as future
 
@@ -32,16 +33,16 @@ def test_accuracy(
         total=vsts.count(),
     ):
         if len(all_stps) > 50000:
-            StopPrediction.objects.bulk_create(all_sps)
-            StopTimePrediction.objects.bulk_create(all_stps)
+            copy_insert(all_sps)
+            copy_insert(all_stps)
             all_sps = []
             all_stps = []
 
         all_sps.extend(sps)
         all_stps.extend(stps)
 
-    StopPrediction.objects.bulk_create(all_sps)
-    StopTimePrediction.objects.bulk_create(all_stps)
+    copy_insert(all_sps)
+    copy_insert(all_stps)
     all_sps = []
     all_stps = []
 
@@ -0,0 +1,117 @@
+from datetime import date, datetime, time, timedelta
+from functools import partial
+import logging
+from multiprocessing import Pool
+
+from django import db
+from django.db import transaction
+from django.db.models import Q
+import tqdm
+
+from timepred.models import BackfillCheckpoint, RawVehicleData, TripInstance
+from timepred.processing.constants import WROCLAW_TZ
+import timepred.processing.present as present
+from timepred.processing.projection import project_records
+
+BATCH_SIZE = 5000
+# records without a route name are never processed
+PROCESSABLE = ~Q(route_name="")
+
+
+def service_day_bounds(day: date, day_start_hour: int) -> tuple[datetime, datetime]:
+    start = datetime.combine(day, time(day_start_hour, tzinfo=WROCLAW_TZ))
+    end = datetime.combine(
+        day + timedelta(days=1), time(day_start_hour, tzinfo=WROCLAW_TZ)
+    )
+    return start, end
+
+
+def service_day_of(timestamp: datetime, day_start_hour: int) -> date:
+    return (timestamp.astimezone(WROCLAW_TZ) - timedelta(hours=day_start_hour)).date()
+
+
+def get_first_unprocessed_day(day_start_hour: int) -> date | None:
+    timestamp = (
+        RawVehicleData.objects.filter(PROCESSABLE, processed=False)
+        .order_by("timestamp")
+        .values_list("timestamp", flat=True)
+        .first()
+    )
+    if timestamp is None:
+        return None
+    return service_day_of(timestamp, day_start_hour)
+
+
+def restart_days(days: list[date], day_start_hour: int):
+    # Forgets that the records of days were processed, so that they are
+    # again. The trip instances made from them go as well, with their stop
+    # times and predictions, or processing again would duplicate them.
+    start, _ = service_day_bounds(days[0], day_start_hour)
+    _, end = service_day_bounds(days[-1], day_start_hour)
+    with transaction.atomic():
+        TripInstance.objects.filter(started_at__gte=start, started_at__lt=end).delete()
+        BackfillCheckpoint.objects.filter(day__in=days).delete()
+        RawVehicleData.objects.filter(
+            PROCESSABLE, processed=True, timestamp__gte=start, timestamp__lt=end
+        ).update(processed=False)
+
+
+def backfill_day(day: date, day_start_hour: int) -> tuple[date, int]:
+    F = f"backfill_day({day})"
+
+    checkpoint, _ = BackfillCheckpoint.objects.get_or_create(day=day)
+    if checkpoint.finished:
+        logging.debug(f"{F} already finished")
+        return day, 0
+
+    start, end = service_day_bounds(day, day_start_hour)
+    if checkpoint.last_timestamp is not None:
+        start = max(start, checkpoint.last_timestamp)
+    logging.debug(f"{F} from {start} to {end}")
+
+    # vehicles are tracked only within the partition
+    present.reset_local()
+
+    # fmt: off
+    unprocessed = (
+        RawVehicleData.objects
+        .filter(PROCESSABLE, processed=False, timestamp__gte=start, timestamp__lt=end)
+        .order_by("timestamp")
+    )
+    # fmt: on
+    n = 0
+    batch = []
+    for rd in unprocessed.iterator(chunk_size=BATCH_SIZE):
+        batch.append(rd)
+        if len(batch) < BATCH_SIZE:
+            continue
+
+        project_records(batch)
+        n += len(present.process_many_data_local(batch))
+        checkpoint.last_timestamp = batch[-1].timestamp
+        checkpoint.save()
+        batch = []
+
+    if len(batch) > 0:
+        project_records(batch)
+        n += len(present.process_many_data_local(batch))
+        checkpoint.last_timestamp = batch[-1].timestamp
+
+    # records of a day that has not ended yet can still arrive
+    checkpoint.finished = end <= datetime.now(WROCLAW_TZ)
+    checkpoint.save()
+
+    return day, n
+
+
+def backfill(days: list[date], jobs: int, day_start_hour: int):
+    db.connections.close_all()
+
+    with Pool(jobs) as pool:
+        for day, n in tqdm.tqdm(
+            pool.imap_unordered(
+                partial(backfill_day, day_start_hour=day_start_hour), days
+            ),
+            total=len(days),
+        ):
+            logging.info(f"backfill: {day} done, {n} records")
@@ -0,0 +1,135 @@
+from collections.abc import Sequence
+from datetime import date, datetime, timedelta
+from io import StringIO
+import logging
+import os
+from typing import Any, TypeVar
+
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry
+from django.db import connection, models, transaction
+
+M = TypeVar("M", bound=models.Model)
+
+
+def reserve_ids(model: type[models.Model], n: int) -> list[int]:
+    if n <= 0:
+        return []
+
+    pk = model._meta.pk
+    assert pk is not None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+            [model._meta.db_table, pk.column, n],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class IdAllocator:
+    # Hands out primary keys reserved from the sequence in blocks, so objects
+    # can be referenced by id before they are written.
+    def __init__(self, model: type[models.Model], block_size: int = 100):
+        self.model = model
+        self.block_size = block_size
+        self.ids: list[int] = []
+        self.pid = os.getpid()
+
+    def next(self) -> int:
+        # a forked process must not reuse the ids reserved by its parent
+        if self.pid != os.getpid():
+            self.ids = []
+            self.pid = os.getpid()
+
+        if len(self.ids) == 0:
+            self.ids = reserve_ids(self.model, self.block_size)
+            self.ids.reverse()
+        return self.ids.pop()
+
+
+def format_copy_value(value: Any) -> str:
+    if value is None:
+        # unquoted empty string is NULL in CSV format
+        return ""
+    if isinstance(value, bool):
+        value = "t" if value else "f"
+    elif isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    elif isinstance(value, timedelta):
+        value = f"{value.days} days {value.seconds} seconds {value.microseconds} microseconds"
+    elif isinstance(value, GEOSGeometry):
+        value = value.hexewkb.decode()
+    else:
+        value = str(value)
+    return '"' + value.replace('"', '""') + '"'
+
+
+def get_copy_value(obj: models.Model, field: models.Field) -> Any:
+    value = field.pre_save(obj, True)
+    if isinstance(value, GEOSGeometry):
+        if value.srid is None:
+            value = value.clone()
+            value.srid = field.srid  # type: ignore
+        return value
+    return field.get_db_prep_save(value, connection)
+
+
+def copy_insert(objs: Sequence[M], *, staging: bool | None = None) -> Sequence[M]:
+    # Like bulk_create, but streams the rows through COPY. Primary keys are
+    # taken from the sequence beforehand, so they are set on objs afterwards.
+    if len(objs) == 0:
+        return objs
+
+    model = type(objs[0])
+    if connection.vendor != "postgresql":
+        return model.objects.bulk_create(objs)
+
+    if staging is None:
+        staging = getattr(settings, "TIMEPRED_COPY_STAGING", False)
+
+    meta = model._meta
+    for obj in objs:
+        obj._prepare_related_fields_for_save(operation_name="copy_insert")
+
+    without_pk = [obj for obj in objs if obj.pk is None]
+    for obj, id in zip(without_pk, reserve_ids(model, len(without_pk))):
+        obj.pk = id
+
+    fields = meta.concrete_fields
+    buffer = StringIO()
+    for obj in objs:
+        buffer.write(
+            ",".join(format_copy_value(get_copy_value(obj, f)) for f in fields)
+        )
+        buffer.write("\n")
+    buffer.seek(0)
+
+    table = connection.ops.quote_name(meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(f.column) for f in fields)
+    with transaction.atomic(), connection.cursor() as cursor:
+        if staging:
+            staging_table = connection.ops.quote_name(f"{meta.db_table}_staging")
+            cursor.execute(
+                f"CREATE UNLOGGED TABLE IF NOT EXISTS {staging_table} (LIKE {table} INCLUDING DEFAULTS)"
+            )
+            cursor.execute(f"TRUNCATE {staging_table}")
+            cursor.cursor.copy_expert(
+                f"COPY {staging_table} ({columns}) FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+            cursor.execute(
+                f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging_table}"
+            )
+            cursor.execute(f"TRUNCATE {staging_table}")
+        else:
+            cursor.cursor.copy_expert(
+                f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer
+            )
+
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = connection.alias
+
+    logging.debug(f"copy_insert({meta.db_table}): {len(objs)} rows")
+
+    return objs
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import time
+from typing import Callable, Generic, Hashable, TypeVar
+
+from django.core.cache import cache
+
+from timepred.processing import metrics
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+FEED_GENERATION_KEY = "timepred:feed_generation"
+# how often processes look for newly imported feeds
+GENERATION_CHECK_INTERVAL = 30
+
+checked_generation: tuple[float, int] | None = None
+
+
+def feed_generation() -> int:
+    global checked_generation
+
+    now = time.monotonic()
+    if (
+        checked_generation is None
+        or now - checked_generation[0] > GENERATION_CHECK_INTERVAL
+    ):
+        checked_generation = (now, cache.get(FEED_GENERATION_KEY, 0))
+    return checked_generation[1]
+
+
+def bump_feed_generation():
+    # invalidates the caches derived from feeds in every process
+    global checked_generation
+
+    try:
+        cache.incr(FEED_GENERATION_KEY)
+    except ValueError:
+        cache.set(FEED_GENERATION_KEY, 1, None)
+    checked_generation = None
+
+
+class LRUCache(Generic[K, V]):
+    # Process-local cache holding at most maxsize values. Values derived from
+    # feeds are dropped when a new feed is imported.
+    def __init__(self, name: str, maxsize: int | None):
+        self.name = name
+        self.maxsize = maxsize
+        self.values: OrderedDict[K, V] = OrderedDict()
+        self.generation = feed_generation()
+
+    def get(self, key: K, factory: Callable[[], V]) -> V:
+        generation = feed_generation()
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+        if key in self.values:
+            self.values.move_to_end(key)
+            metrics.count(f"{self.name}.hit")
+            return self.values[key]
+
+        metrics.count(f"{self.name}.miss")
+        value = factory()
+        self.set(key, value)
+        return value
+
+    def set(self, key: K, value: V):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        if self.maxsize is not None and len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+
+    def items(self) -> list[tuple[K, V]]:
+        return list(self.values.items())
+
+    def load(self, items: list[tuple[K, V]]):
+        # values saved elsewhere, the caller checks that they are for the
+        # same feeds
+        generation = feed_generation()
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+        for key, value in items:
+            self.set(key, value)
+
+    def clear(self):
+        self.values.clear()
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class CycleMemo(Generic[K, V]):
+    # Results computed for the records of one cycle. Keys include the raw
+    # record, so entries never go stale; clear just frees them. Workers
+    # don't see where a cycle ends and rely on maxsize instead.
+    def __init__(self, name: str, maxsize: int = 10000):
+        self.name = name
+        self.maxsize = maxsize
+        self.values: dict[K, V] = {}
+
+    def get(self, key: K, factory: Callable[[], V]) -> V:
+        if key in self.values:
+            metrics.count(f"{self.name}.hit")
+            return self.values[key]
+
+        metrics.count(f"{self.name}.miss")
+        value = factory()
+        if len(self.values) >= self.maxsize:
+            self.values.clear()
+        self.values[key] = value
+        return value
+
+    def clear(self):
+        self.values.clear()
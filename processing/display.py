@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+import logging
+from typing import Any
+
+import numpy as np
+import shapely
+
+from multigtfs.models.feed import Feed
+from multigtfs.models.trip import Trip
+from timepred.models import TripPattern
+from timepred.processing.cache import LRUCache
+from timepred.processing.constants import WROCLAW_UTM, WSG84
+from timepred.processing.patterns import get_pattern
+from timepred.processing.projection import transform_coords
+from timepred.processing.shapes import (
+    ShapeIndex,
+    get_simplified_trip_shape,
+    get_trip_shape,
+)
+
+# Everything views.details draws, computed once per pattern at feed import,
+# so that a request only has to split the line at the vehicle's shape_dist.
+
+
+@dataclass
+class DisplayGeometry:
+    # simplified shape in WSG84, indexed by distance along the full shape
+    index: ShapeIndex
+    # every stop projected onto the shape, in stop_sequence order, WSG84
+    stops: list[list[float]]
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "coords": self.index.coords.tolist(),
+            "distances": self.index.distance_list,
+            "stops": self.stops,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> "DisplayGeometry":
+        return cls(
+            index=ShapeIndex(np.array(data["coords"]), np.array(data["distances"])),
+            stops=data["stops"],
+        )
+
+
+def vertex_distances(shape: ShapeIndex, simplified: ShapeIndex) -> np.ndarray:
+    # simplify keeps a subset of the vertices, they are found in order
+    distances = np.empty(len(simplified))
+    j = 0
+    for i, vertex in enumerate(simplified.coords):
+        while j < len(shape) - 1 and not np.array_equal(shape.coords[j], vertex):
+            j += 1
+        distances[i] = shape.distances[j]
+    return distances
+
+
+def build_display_geometry(trip: Trip) -> DisplayGeometry:
+    shape = get_trip_shape(trip)
+    simplified = get_simplified_trip_shape(trip)
+
+    shape_dists = list(
+        trip.stoptime_set.order_by("stop_sequence").values_list(
+            "shape_dist_traveled", flat=True
+        )
+    )
+    stops = shapely.get_coordinates(
+        shapely.line_interpolate_point(shape.line, shape_dists)
+    )
+
+    return DisplayGeometry(
+        index=ShapeIndex(
+            transform_coords(simplified.index.coords, WROCLAW_UTM, WSG84),
+            vertex_distances(shape.index, simplified.index),
+        ),
+        stops=transform_coords(stops, WROCLAW_UTM, WSG84).tolist(),
+    )
+
+
+def build_display_geometries(feed: Feed | None = None):
+    patterns = TripPattern.objects.filter(display__isnull=True).select_related("trip")
+    if feed is not None:
+        patterns = patterns.filter(feed=feed)
+
+    batch = []
+    for pattern in patterns.iterator(chunk_size=100):
+        pattern.display = build_display_geometry(pattern.trip).to_json()
+        batch.append(pattern)
+        if len(batch) >= 100:
+            TripPattern.objects.bulk_update(batch, ["display"])
+            batch = []
+    TripPattern.objects.bulk_update(batch, ["display"])
+
+    logging.info(f"build_display_geometries({feed}) done")
+
+
+display_cache: LRUCache[tuple[str, int], DisplayGeometry] = LRUCache(
+    "display_cache", 256
+)
+
+
+def load_display_geometry(trip: Trip, pattern_id: int | None) -> DisplayGeometry:
+    if pattern_id is not None:
+        data = (
+            TripPattern.objects.filter(id=pattern_id)
+            .values_list("display", flat=True)
+            .first()
+        )
+        if data is not None:
+            return DisplayGeometry.from_json(data)
+    # not built yet
+    return build_display_geometry(trip)
+
+
+def get_display_geometry(trip: Trip) -> DisplayGeometry:
+    pattern = get_pattern(trip.id, trip.service_id)  # type: ignore
+    pattern_id = pattern[0] if pattern is not None else None
+    key = ("pattern", pattern_id) if pattern_id is not None else ("trip", trip.id)
+    return display_cache.get(key, lambda: load_display_geometry(trip, pattern_id))
@@ -14,7 +14,9 @@ from timepred.models import (
 from multigtfs.models.stop_time import StopTime
 from datetime import datetime, time, timedelta
 
+from timepred.processing.bulk import copy_insert
 from timepred.processing.future.strategy import EstimationStrategy
+from timepred.processing.stoptimes import get_stoptime_table
 
 
 def get_stoptime_predictions(
@@ -47,8 +49,8 @@ def estimate_and_save_stoptime_predictions(
 ):
     all_sps, all_stps = get_stoptime_predictions(vst, strategy)
 
-    StopPrediction.objects.bulk_create(all_sps)
-    StopTimePrediction.objects.bulk_create(all_stps)
+    copy_insert(all_sps)
+    copy_insert(all_stps)
 
 
 def estimate_travel_time_vst(
@@ -63,10 +65,8 @@ def estimate_travel_time_vst(
     est_arrivals[vst.stoptime][vst.arrival_time] = 1
 
     st_tt: dict[StopTime, dict[datetime, float]] = defaultdict(dict)
-    next_stoptimes = list(
-        vst.trip_instance.trip.stoptime_set.select_related("stop")
-        .filter(stop_sequence__gt=vst.stoptime.stop_sequence)
-        .order_by("stop_sequence")
+    next_stoptimes = get_stoptime_table(vst.trip_instance.trip).after(
+        vst.stoptime.stop_sequence
     )
 
     est_arrivals = strategy.estimate_travel_time(vst, next_stoptimes)
@@ -1,159 +1,224 @@
+from collections import defaultdict
+import logging
+from multiprocessing import Pool
+
+from django import db
+from django.conf import settings
 from django.db.models import Exists, OuterRef
+import numpy as np
 import shapely
+import tqdm
 
 from multigtfs.models.stop_time import StopTime
 from multigtfs.models.trip import Trip
-from timepred.processing.constants import WROCLAW_UTM
+from timepred.models import TripPattern
+from timepred.processing.cache import bump_feed_generation
+from timepred.processing.constants import WROCLAW_UTM, WSG84
+from timepred.processing.display import build_display_geometries
+from timepred.processing.projection import transform_coords
+from timepred.processing.shapes import ShapeIndex, get_trip_shape, shape_key
 
 
 def cut(
     line: shapely.LineString, distance: float
 ) -> tuple[shapely.LineString, shapely.LineString]:
     # Cuts a line in two at a distance from its starting point
-    if distance <= 0.0 or distance >= line.length:
-        return (shapely.LineString([]), shapely.LineString(line))
-    coords = list(line.coords)
-    for i, p in enumerate(coords):
-        pd = line.project(shapely.Point(p))
-        if pd == distance:
-            return (shapely.LineString(coords[: i + 1]), shapely.LineString(coords[i:]))
-        if pd > distance:
-            cp = line.interpolate(distance)
-            return (
-                shapely.LineString(coords[:i] + [(cp.x, cp.y)]),
-                shapely.LineString([(cp.x, cp.y)] + coords[i:]),
-            )
-
-    assert False
+    return ShapeIndex.from_line(line).cut(distance)
 
 
 def remove_closest_segments(
     shape: shapely.LineString, point: shapely.Point, dist: float
 ) -> tuple[shapely.LineString, shapely.LineString]:
-    distance = shape.project(point)
-    max_dist_left = distance - dist
-    min_dist_right = distance + dist
-    empty = shapely.LineString([])
-
-    coords = list(shape.coords)
-    left = 0
-    N = len(coords)
-    right = N - 1
-    while left != right:
-        middle = (left + right) // 2
-        mp = coords[middle]
-        md = shape.project(shapely.Point(mp))
-        if md <= distance:
-            left = middle + 1
-        else:
-            right = middle
-
-    while left >= 1:
-        ld = shape.project(shapely.Point(coords[left - 1]))
-        if max_dist_left < ld:
-            left -= 1
-        else:
-            break
-
-    while right < N:
-        rd = shape.project(shapely.Point(coords[right]))
-        if rd < min_dist_right:
-            right += 1
-        else:
-            break
-
-    return (
-        shapely.LineString(coords[:left]) if left > 1 else empty,
-        shapely.LineString(coords[right:]) if right < N - 1 else empty,
+    return ShapeIndex.from_line(shape).remove_closest_segments(
+        shape.project(point), dist
     )
 
 
-def fix_unmonotone_stops():
-    flipped_stops = StopTime.objects.filter(
-        Exists(
-            StopTime.objects.filter(
-                trip_id=OuterRef("trip_id"),
-                stop_sequence__gt=OuterRef("stop_sequence"),
-                shape_dist_traveled__lt=OuterRef("shape_dist_traveled"),
-            )
-        )
+def project_on_segments(
+    index: ShapeIndex, point: tuple[float, float]
+) -> tuple[np.ndarray, np.ndarray]:
+    # distance from point to every segment and the shape distance of the
+    # closest point on that segment
+    coords, distances = index.coords, index.distances
+    p = np.asarray(point, dtype=np.float64)
+    starts = coords[:-1]
+    segments = coords[1:] - starts
+    lengths2 = np.einsum("ij,ij->i", segments, segments)
+    t = np.einsum("ij,ij->i", p - starts, segments) / np.where(
+        lengths2 > 0, lengths2, 1
     )
-    trips = set(st.trip for st in flipped_stops)
-    N = len(trips)
-    for i, trip in enumerate(trips):
-        print(f"\r{i}/{N}", end="")
-        fix_unmonotone_stops_trip(trip)
+    t = np.clip(t, 0.0, 1.0)
+    closest = starts + t[:, None] * segments
+    dist = np.hypot(closest[:, 0] - p[0], closest[:, 1] - p[1])
+    along = np.where(
+        t >= 1.0,
+        distances[1:],
+        distances[:-1] + t * (distances[1:] - distances[:-1]),
+    )
+    return dist, along
+
+
+def shape_dist_candidates(
+    index: ShapeIndex,
+    point: tuple[float, float],
+    threshold: float,
+    gap: float,
+) -> list[float]:
+    # Shape distances of every pass of the shape within threshold of point.
+    # Takes the closest projection, removes the segments within gap of it
+    # (see ShapeIndex.remove_closest_segments) and repeats on what is left
+    # on both sides. Candidates are listed in that order: closest, left, right.
+    if len(index) < 2:
+        return []
+
+    dist, along = project_on_segments(index, point)
+
+    candidates: list[float] = []
+    # vertex ranges [start, end) of the remaining pieces
+    stack = [(0, len(index))]
+    while len(stack) > 0:
+        start, end = stack.pop()
+        i = start + int(np.argmin(dist[start : end - 1]))
+        if dist[i] > threshold:
+            continue
+
+        shape_dist = float(along[i])
+        candidates.append(shape_dist)
+
+        left, right = index.closest_segments(shape_dist, gap, start, end)
+        if right < end - 1:
+            stack.append((right, end))
+        if left > start + 1:
+            stack.append((start, left))
+
+    return candidates
+
+
+def find_monotone_shape_dists(candidates: list[list[float]]) -> list[float] | None:
+    # Picks one candidate per stop so that they never decrease, preferring
+    # earlier candidates of earlier stops, in O(n * k). upper[i] is the
+    # largest candidate of stop i that the stops after it can still follow.
+    upper = [np.inf] * (len(candidates) + 1)
+    for i in range(len(candidates) - 1, -1, -1):
+        feasible = [sd for sd in candidates[i] if sd <= upper[i + 1]]
+        if len(feasible) == 0:
+            return None
+        upper[i] = max(feasible)
 
+    shape_dists = []
+    alpha = 0.0
+    for i, stop_candidates in enumerate(candidates):
+        # there is one, upper[i] itself qualifies
+        alpha = next(sd for sd in stop_candidates if alpha <= sd <= upper[i + 1])
+        shape_dists.append(alpha)
+    return shape_dists
 
-def get_flipped_stoptimes(stop_times: list[StopTime]):
-    return [
-        st1
-        for st1 in stop_times
-        for st2 in stop_times
-        if st1.stop_sequence < st2.stop_sequence
-        and st1.shape_dist_traveled > st2.shape_dist_traveled  # type: ignore
-        or st1.stop_sequence > st2.stop_sequence
-        and st1.shape_dist_traveled < st2.shape_dist_traveled  # type: ignore
-    ]
 
+def get_monotone_shape_dists(trip: Trip) -> list[float] | None:
+    stop_times = list(
+        trip.stoptime_set.select_related("stop").order_by("stop_sequence")
+    )
+    shape = get_trip_shape(trip)
 
-def fix_unmonotone_stops_trip(trip: Trip):
-    stop_times = list(trip.stoptime_set.order_by("stop_sequence").all())
+    positions = transform_coords(
+        [st.stop.point.coords for st in stop_times], WSG84, WROCLAW_UTM
+    )
+    dist_thresholds = np.maximum(
+        50, shapely.distance(shape.line, shapely.points(positions)) * 4
+    )
 
-    possible_shape_dists = dict()
-    for st in stop_times:
-        position = st.stop.point.clone()
-        position.transform(WROCLAW_UTM)
-        position = shapely.Point(position.coords)
-
-        shape = st.trip.geometry.clone()
-        shape.transform(WROCLAW_UTM)
-        shape = shapely.LineString(shape.coords)
-
-        dist_threshold = max(50, shape.distance(position) * 4)
-
-        def get_sensible_shape_dists(
-            shape: shapely.LineString, dist: float
-        ) -> list[float]:
-            if shape.is_empty:
-                return []
-            if shape.distance(position) > dist_threshold:
-                return []
-
-            sd = dist + shape.project(position)
-
-            left, right = remove_closest_segments(shape, position, 0)
-            left_sd = get_sensible_shape_dists(left, dist)
-            if right.is_empty:
-                right_sd = []
-            else:
-                right_sd = get_sensible_shape_dists(
-                    right, dist + shape.project(shapely.Point(right.coords[0]))
-                )
+    return find_monotone_shape_dists(
+        [
+            shape_dist_candidates(shape.index, position, dist_threshold, 0)
+            for position, dist_threshold in zip(positions, dist_thresholds)
+        ]
+    )
 
-            return [sd] + left_sd + right_sd
 
-        possible_shape_dists[st] = get_sensible_shape_dists(shape, 0)
+def get_monotone_shape_dists_by_id(trip_id: int) -> tuple[int, list[float] | None]:
+    return trip_id, get_monotone_shape_dists(Trip.objects.get(id=trip_id))
 
-    def find_sensible(prefix: list[StopTime], suffix: list[StopTime], alpha: float):
-        if len(suffix) == 0:
-            if len(get_flipped_stoptimes(prefix)) == 0:
-                return prefix
-            return None
 
-        for sd in possible_shape_dists[suffix[0]]:
-            if sd < alpha:
-                continue
-            suffix[0].shape_dist_traveled = sd
-            if sensible := find_sensible(prefix + [suffix[0]], suffix[1:], sd):
-                return sensible
+def save_shape_dists(trip_ids: list[int], shape_dists: list[float]):
+    stop_times = list(
+        StopTime.objects.filter(trip_id__in=trip_ids)
+        .only("id", "trip_id", "stop_sequence", "shape_dist_traveled")
+        .order_by("trip_id", "stop_sequence")
+    )
+    by_trip = defaultdict(list)
+    for st in stop_times:
+        by_trip[st.trip_id].append(st)  # type: ignore
+    for trip_stop_times in by_trip.values():
+        for st, sd in zip(trip_stop_times, shape_dists):
+            st.shape_dist_traveled = sd
+
+    StopTime.objects.bulk_update(stop_times, ["shape_dist_traveled"], batch_size=1000)
+
+
+def shape_dists_changed(trip_ids: list[int]):
+    # display geometries place the stops at their shape_dist_traveled, and
+    # every process may hold the old ones in stoptime_cache and display_cache
+    TripPattern.objects.filter(patterntrip__trip_id__in=trip_ids).update(display=None)
+    build_display_geometries()
+    bump_feed_generation()
 
-        return None
 
-    sensible = find_sensible([], stop_times, 0)
-    if sensible is None:
-        print(possible_shape_dists)
-        print(trip)
+def fix_unmonotone_stops_trip(trip: Trip):
+    shape_dists = get_monotone_shape_dists(trip)
+    if shape_dists is None:
+        logging.warning(f"fix_unmonotone_stops_trip({trip}): no monotone stops")
         return
-    for st in sensible:
-        st.save()
+    save_shape_dists([trip.id], shape_dists)
+    shape_dists_changed([trip.id])
+
+
+def fix_unmonotone_stops(jobs: int | None = None):
+    if jobs is None:
+        jobs = getattr(settings, "TIMEPRED_NPROC", 2)
+
+    flipped_trip_ids = set(
+        StopTime.objects.filter(
+            Exists(
+                StopTime.objects.filter(
+                    trip_id=OuterRef("trip_id"),
+                    stop_sequence__gt=OuterRef("stop_sequence"),
+                    shape_dist_traveled__lt=OuterRef("shape_dist_traveled"),
+                )
+            )
+        ).values_list("trip_id", flat=True)
+    )
+
+    # trips with the same shape and stops get the same shape_dists
+    stops = defaultdict(list)
+    for trip_id, stop_id in (
+        StopTime.objects.filter(trip_id__in=flipped_trip_ids)
+        .order_by("trip_id", "stop_sequence")
+        .values_list("trip_id", "stop_id")
+    ):
+        stops[trip_id].append(stop_id)
+    groups: dict[tuple, list[int]] = defaultdict(list)
+    for trip in Trip.objects.filter(id__in=flipped_trip_ids).only(
+        "id", "shape_id", "service_id"
+    ):
+        groups[(shape_key(trip), tuple(stops[trip.id]))].append(trip.id)
+    by_representative = {trip_ids[0]: trip_ids for trip_ids in groups.values()}
+
+    logging.info(
+        f"fix_unmonotone_stops: {len(flipped_trip_ids)} trips, {len(groups)} patterns"
+    )
+
+    fixed_trip_ids = []
+    db.connections.close_all()
+    with Pool(jobs) as pool:
+        for trip_id, shape_dists in tqdm.tqdm(
+            pool.imap_unordered(get_monotone_shape_dists_by_id, by_representative),
+            total=len(by_representative),
+        ):
+            if shape_dists is None:
+                logging.warning(f"fix_unmonotone_stops: no monotone stops, {trip_id}")
+                continue
+            save_shape_dists(by_representative[trip_id], shape_dists)
+            fixed_trip_ids.extend(by_representative[trip_id])
+
+    if len(fixed_trip_ids) > 0:
+        shape_dists_changed(fixed_trip_ids)
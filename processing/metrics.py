@@ -0,0 +1,173 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+import os
+import time
+from typing import Any, Callable, TypeVar
+
+from django.core.cache import cache
+
+# Every process keeps its own registry and periodically publishes it to the
+# Django cache, from where collect merges them. Use a cache backend shared
+# between processes (not the default LocMemCache) to see the workers.
+
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+PUBLISH_INTERVAL = 5
+CACHE_TIMEOUT = 60
+PIDS_KEY = "timepred:metrics:pids"
+
+T = TypeVar("T", bound=Callable[..., Any])
+
+
+@dataclass
+class Histogram:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    buckets: list[int] = field(default_factory=lambda: [0] * (len(BUCKETS) + 1))
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+
+    def merge(self, other: "Histogram"):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def quantile(self, q: float) -> float | None:
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS + [self.max], self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+@dataclass
+class Registry:
+    started_at: float = field(default_factory=time.time)
+    histograms: dict[str, Histogram] = field(default_factory=dict)
+    counters: dict[str, float] = field(default_factory=dict)
+    gauges: dict[str, float] = field(default_factory=dict)
+
+
+registry = Registry()
+last_publish = 0.0
+registry_pid = os.getpid()
+
+
+def get_registry() -> Registry:
+    # forked workers start with their own, empty registry
+    global registry, registry_pid
+    if registry_pid != os.getpid():
+        registry = Registry()
+        registry_pid = os.getpid()
+    return registry
+
+
+def observe(stage: str, seconds: float):
+    histograms = get_registry().histograms
+    if stage not in histograms:
+        histograms[stage] = Histogram()
+    histograms[stage].observe(seconds)
+
+
+def count(name: str, n: float = 1):
+    counters = get_registry().counters
+    counters[name] = counters.get(name, 0) + n
+
+
+def gauge(name: str, value: float):
+    get_registry().gauges[name] = value
+
+
+@contextmanager
+def timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timed(stage: str) -> Callable[[T], T]:
+    def decorator(f: T) -> T:
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return f(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def publish(force: bool = False):
+    global last_publish
+
+    now = time.time()
+    if not force and now - last_publish < PUBLISH_INTERVAL:
+        return
+    last_publish = now
+
+    pid = os.getpid()
+    cache.set(f"timepred:metrics:{pid}", get_registry(), CACHE_TIMEOUT)
+    pids = cache.get(PIDS_KEY, set())
+    if pid not in pids:
+        cache.set(PIDS_KEY, pids | {pid}, None)
+
+
+def collect() -> dict:
+    pids = cache.get(PIDS_KEY, set())
+    registries = cache.get_many([f"timepred:metrics:{pid}" for pid in pids])
+    # processes that stopped publishing, their registries have expired
+    expired = {pid for pid in pids if f"timepred:metrics:{pid}" not in registries}
+    if len(expired) > 0:
+        cache.set(PIDS_KEY, cache.get(PIDS_KEY, set()) - expired, None)
+    if os.getpid() not in pids:
+        registries[f"timepred:metrics:{os.getpid()}"] = get_registry()
+
+    now = time.time()
+    histograms: dict[str, Histogram] = {}
+    counters: dict[str, float] = {}
+    gauges: dict[str, float] = {}
+    processes = {}
+    for key, r in registries.items():
+        for name, h in r.histograms.items():
+            histograms.setdefault(name, Histogram()).merge(h)
+        for name, n in r.counters.items():
+            counters[name] = counters.get(name, 0) + n
+        gauges.update(r.gauges)
+
+        worker = r.histograms.get("worker")
+        if worker is not None:
+            processes[key.split(":")[-1]] = {
+                "records": worker.count,
+                "utilization": worker.total / max(now - r.started_at, 1e-9),
+            }
+
+    return {
+        "stages": {
+            name: {
+                "count": h.count,
+                "total": h.total,
+                "mean": h.total / h.count if h.count > 0 else None,
+                "p50": h.quantile(0.5),
+                "p95": h.quantile(0.95),
+                "max": h.max,
+                "buckets": dict(zip([str(b) for b in BUCKETS] + ["inf"], h.buckets)),
+            }
+            for name, h in sorted(histograms.items())
+        },
+        "counters": counters,
+        "gauges": gauges,
+        "workers": processes,
+    }
@@ -0,0 +1,165 @@
+from datetime import date, datetime, time, timedelta
+import logging
+import re
+
+from django.db import connection, transaction
+
+from timepred.models import RawVehicleData, RawVehicleDataRollup
+from timepred.processing.constants import WROCLAW_TZ
+
+PARENT = RawVehicleData._meta.db_table
+LEGACY = f"{PARENT}_legacy"
+DEFAULT = f"{PARENT}_default"
+PARTITION_PATTERN = re.compile(rf"^{PARENT}_p(\d{{8}})$")
+BOUND_PATTERN = re.compile(r"TO \('([^']+)'\)")
+
+
+def day_start(day: date) -> datetime:
+    return datetime.combine(day, time(0, tzinfo=WROCLAW_TZ))
+
+
+def partition_name(day: date) -> str:
+    return f"{PARENT}_p{day:%Y%m%d}"
+
+
+def mark_processed(rds: list[RawVehicleData]):
+    # Rows are matched on (id, timestamp), the primary key, and the bounds on
+    # timestamp let the planner skip the partitions the rows are not in.
+    if len(rds) == 0:
+        return
+
+    timestamps = [rd.timestamp for rd in rds]
+    RawVehicleData.objects.filter(
+        id__in=[rd.id for rd in rds],
+        timestamp__gte=min(timestamps),
+        timestamp__lte=max(timestamps),
+    ).update(processed=True)
+
+
+def get_partitions() -> dict[str, str]:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s
+            """,
+            [PARENT],
+        )
+        return dict(cursor.fetchall())
+
+
+def get_daily_partitions() -> dict[date, str]:
+    return {
+        datetime.strptime(m.group(1), "%Y%m%d").date(): name
+        for name in get_partitions()
+        if (m := PARTITION_PATTERN.match(name))
+    }
+
+
+def get_legacy_end() -> datetime | None:
+    bound = get_partitions().get(LEGACY)
+    if bound is None:
+        return None
+
+    m = BOUND_PATTERN.search(bound)
+    if m is None:
+        return None
+    return datetime.fromisoformat(m.group(1))
+
+
+def create_partition(day: date):
+    name = partition_name(day)
+    start, end = day_start(day), day_start(day + timedelta(days=1))
+    logging.info(f"create_partition({day}): {name}")
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # rows that landed in the default partition have to be moved out
+        # before a partition covering them can be attached
+        cursor.execute(f'CREATE TABLE "{name}" (LIKE "{PARENT}" INCLUDING DEFAULTS)')
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM "{DEFAULT}"
+                WHERE "timestamp" >= %s AND "timestamp" < %s
+                RETURNING *
+            )
+            INSERT INTO "{name}" SELECT * FROM moved
+            """,
+            [start, end],
+        )
+        cursor.execute(
+            f'ALTER TABLE "{PARENT}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)',
+            [start, end],
+        )
+
+
+def ensure_partitions(ahead: int):
+    existing = get_daily_partitions()
+    legacy_end = get_legacy_end()
+
+    today = datetime.now(WROCLAW_TZ).date()
+    for i in range(ahead + 1):
+        day = today + timedelta(days=i)
+        if day in existing:
+            continue
+        if legacy_end is not None and day_start(day) < legacy_end:
+            continue
+        create_partition(day)
+
+
+def rollup(table: str, start: datetime | None, end: datetime, interval: int):
+    logging.info(f"rollup({table}, {start}, {end}, {interval})")
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO "{RawVehicleDataRollup._meta.db_table}"
+                (vehicle_id, route_id, route_name, brigade_id, "timestamp", latitude, longitude, count)
+            SELECT
+                vehicle_id,
+                route_id,
+                max(route_name),
+                brigade_id,
+                to_timestamp(floor(extract(epoch from "timestamp") / %(interval)s) * %(interval)s) AS bucket,
+                avg(latitude),
+                avg(longitude),
+                count(*)
+            FROM "{table}"
+            WHERE (%(start)s::timestamptz IS NULL OR "timestamp" >= %(start)s) AND "timestamp" < %(end)s
+            GROUP BY vehicle_id, route_id, brigade_id, bucket
+            """,
+            {"interval": interval, "start": start, "end": end},
+        )
+
+
+def drop_partition(name: str):
+    logging.info(f"drop_partition({name})")
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE "{PARENT}" DETACH PARTITION "{name}"')
+        cursor.execute(f'DROP TABLE "{name}"')
+
+
+def apply_retention(retention_days: int, rollup_interval: int | None):
+    cutoff_day = datetime.now(WROCLAW_TZ).date() - timedelta(days=retention_days)
+    cutoff = day_start(cutoff_day)
+
+    for day, name in sorted(get_daily_partitions().items()):
+        if day >= cutoff_day:
+            continue
+        with transaction.atomic():
+            if rollup_interval is not None:
+                rollup(name, None, cutoff, rollup_interval)
+            drop_partition(name)
+
+    # the legacy and default partitions can't be dropped as a whole
+    for name in [LEGACY, DEFAULT]:
+        if name not in get_partitions():
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            if rollup_interval is not None:
+                rollup(name, None, cutoff, rollup_interval)
+            cursor.execute(f'DELETE FROM "{name}" WHERE "timestamp" < %s', [cutoff])
@@ -0,0 +1,89 @@
+from collections import defaultdict
+import hashlib
+import logging
+
+from django.contrib.gis.db.models.functions import AsWKB
+from django.db import transaction
+from django.db.models import CharField, Exists, Func, OuterRef
+
+from multigtfs.models.feed import Feed
+from multigtfs.models.stop_time import StopTime
+from multigtfs.models.trip import Trip
+from timepred.models import PatternTrip, TripPattern
+from timepred.processing.cache import LRUCache
+
+
+def build_patterns(feed: Feed):
+    # Groups the trips of a feed by geometry and stops, so that anything
+    # derived from them is computed once per pattern instead of per trip.
+    trips = (
+        Trip.objects.filter(route__feed=feed, geometry__isnull=False)
+        .annotate(
+            geometry_hash=Func(
+                AsWKB("geometry"), function="md5", output_field=CharField()
+            )
+        )
+        .values_list("id", "geometry_hash")
+    )
+
+    stops = defaultdict(list)
+    for trip_id, stop_id in (
+        StopTime.objects.filter(trip__route__feed=feed)
+        .order_by("trip_id", "stop_sequence")
+        .values_list("trip_id", "stop_id")
+    ):
+        stops[trip_id].append(stop_id)
+
+    patterns: dict[str, TripPattern] = {}
+    members: list[tuple[int, str]] = []
+    for trip_id, geometry_hash in trips:
+        key = hashlib.sha256(
+            f"{geometry_hash}:{','.join(map(str, stops[trip_id]))}".encode()
+        ).hexdigest()
+        if key not in patterns:
+            patterns[key] = TripPattern(
+                feed=feed, key=key, geometry_hash=geometry_hash, trip_id=trip_id
+            )
+        members.append((trip_id, key))
+
+    with transaction.atomic():
+        TripPattern.objects.filter(feed=feed).delete()
+        TripPattern.objects.bulk_create(patterns.values(), batch_size=1000)
+        PatternTrip.objects.bulk_create(
+            [
+                PatternTrip(trip_id=trip_id, pattern=patterns[key])
+                for trip_id, key in members
+            ],
+            batch_size=5000,
+        )
+
+    logging.info(
+        f"build_patterns({feed}): {len(members)} trips, {len(patterns)} patterns"
+    )
+
+
+def build_missing_patterns() -> int:
+    feeds = list(
+        Feed.objects.filter(~Exists(TripPattern.objects.filter(feed=OuterRef("pk"))))
+    )
+    for feed in feeds:
+        build_patterns(feed)
+    return len(feeds)
+
+
+# service id -> trip id -> (pattern id, geometry hash) of its registered
+# trips, only the services running on the days looked at are loaded
+pattern_cache: LRUCache[int, dict[int, tuple[int, str]]] = LRUCache("pattern_cache", 64)
+
+
+def load_patterns(service_id: int) -> dict[int, tuple[int, str]]:
+    return {
+        trip_id: (pattern_id, geometry_hash)
+        for trip_id, pattern_id, geometry_hash in PatternTrip.objects.filter(
+            trip__service_id=service_id
+        ).values_list("trip_id", "pattern_id", "pattern__geometry_hash")
+    }
+
+
+def get_pattern(trip_id: int, service_id: int) -> tuple[int, str] | None:
+    return pattern_cache.get(service_id, lambda: load_patterns(service_id)).get(trip_id)
@@ -1,11 +1,10 @@
 from collections import defaultdict
-from datetime import timedelta
+from datetime import datetime, timedelta
 from functools import cache
 import logging
 import itertools
 from multiprocessing.managers import DictProxy
 import os
-from typing import Iterable
 from django.conf import settings
 from django.db import IntegrityError, transaction
 from django import db
@@ -34,8 +33,13 @@ from multigtfs.models.route import Route
 from multigtfs.models.stop_time import StopTime
 from multigtfs.models.trip import Trip
 from timepred.processing.present import guess
+from timepred.processing.present.get import shape_dist_memo
 from timepred.processing.present.guess import guess_delay, guess_vehicle_data
+from timepred.processing import metrics
+from timepred.processing.partitions import mark_processed
+from timepred.processing.present.buffer import WriteBuffer
 from timepred.processing.present.update import update_vehicle_data
+from timepred.processing import snapshot
 import timepred.processing.future as future
 
 from multiprocessing import Pool, Manager, Process, Queue
@@ -44,29 +48,173 @@ STRATEGY: EstimationStrategy = SingleStopStrategy(
     20, get_average_travel_times, round_to_n_seconds(15), True
 )
 
-m = Manager()
-vehicle_queue: "Queue[RawVehicleData]" = Queue(1000)
+vehicle_queue: "Queue[RawVehicleData] | ShardedQueue" = Queue(1000)
 result_queue: "Queue[tuple[int, VehicleCache | None]]" = Queue(1000)
-vehicle_cache: "DictProxy[int, VehicleCache]" = m.dict()
+vehicle_cache: "DictProxy[int, VehicleCache] | dict[int, VehicleCache]" = {}
 vehicle_by_trip: dict[int, VehicleCache] = {}
+# state of the rows currently in the VehicleCache table
+persisted_vehicles: dict[int, tuple] = {}
+write_buffer = WriteBuffer()
+# vehicles last seen before this are kept in memory, but not in the table
+stale_before: datetime | None = None
 
 
-def init(interactive: bool):
+def shard_of(vehicle_id: int, nshards: int) -> int:
+    return vehicle_id % nshards
+
+
+class ShardedQueue:
+    # Routes every vehicle to the worker owning its shard. The workers keep
+    # the state of their vehicles locally, so every change made here has to
+    # be sent to them with sync.
+    def __init__(self, nshards: int):
+        self.queues: "list[Queue[ShardMessage]]" = [Queue(1000) for _ in range(nshards)]
+
+    def put(self, rd: RawVehicleData):
+        self.queues[shard_of(rd.vehicle_id, len(self.queues))].put(rd)
+
+    def sync(self, vehicle_id: int, vc: VehicleCache | None):
+        self.queues[shard_of(vehicle_id, len(self.queues))].put((vehicle_id, vc))
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+
+ShardMessage = RawVehicleData | tuple[int, VehicleCache | None]
+
+
+def init(interactive: bool, sharded: bool | None = None):
+    global vehicle_queue, vehicle_cache
+
     guess.init(interactive)
+    # before the fork, so that every worker starts with the caches filled
+    snapshot.load_snapshot(guess.route_by_date)  # type: ignore
 
     db.connections.close_all()
 
     nproc = getattr(settings, "TIMEPRED_NPROC", 2)
-    for _ in range(nproc):
-        p = Process(
-            target=_process_raw_data,
-            args=(vehicle_queue, result_queue, vehicle_cache),
-        )
-        p.start()
+    if sharded is None:
+        sharded = getattr(settings, "TIMEPRED_SHARDED", False)
+
+    if sharded:
+        vehicle_queue = ShardedQueue(nproc)
+        vehicle_cache = {}
+        for shard, shard_queue in enumerate(vehicle_queue.queues):
+            p = Process(
+                target=_process_raw_data_sharded,
+                args=(shard_queue, result_queue, shard, nproc),
+            )
+            p.start()
+    else:
+        vehicle_cache = Manager().dict()
+        for _ in range(nproc):
+            p = Process(
+                target=_process_raw_data,
+                args=(vehicle_queue, result_queue, vehicle_cache),
+            )
+            p.start()
 
     for vc in VehicleCache.objects.all():
         vehicle_cache[vc.vehicle_id] = vc
         vehicle_by_trip[vc.trip_id] = vc
+        persisted_vehicles[vc.vehicle_id] = vehicle_state(vc)
+
+
+def vehicle_state(vc: VehicleCache) -> tuple:
+    return (
+        vc.timestamp,
+        vc.shape_dist,
+        vc.route_id,
+        vc.trip_id,
+        vc.trip_instance_id,
+        vc.next_stoptime_id,
+        vc.current_vehiclestoptime_id,
+        vc.raw_id,
+    )
+
+
+@metrics.timed("vehicle_cache_flush")
+def save_vehicle_cache():
+    F = "save_vehicle_cache()"
+
+    vcs = [
+        vc
+        for vc in vehicle_cache.values()
+        if stale_before is None or vc.timestamp >= stale_before
+    ]
+    changed = []
+    for vc in vcs:
+        vc._prepare_related_fields_for_save(operation_name="save_vehicle_cache")
+        if persisted_vehicles.get(vc.vehicle_id) != vehicle_state(vc):
+            changed.append(vc)
+
+    current = set(vc.vehicle_id for vc in vcs)
+    removed = [
+        vehicle_id for vehicle_id in persisted_vehicles if vehicle_id not in current
+    ]
+    # trip and trip_instance are unique, so rows that are about to take
+    # another vehicle's trip have to be removed before the upsert
+    moved = [
+        vc.vehicle_id
+        for vc in changed
+        if vc.vehicle_id in persisted_vehicles
+        and persisted_vehicles[vc.vehicle_id][3:5] != (vc.trip_id, vc.trip_instance_id)
+    ]
+    logging.debug(
+        f"{F} {len(changed)} changed, {len(removed)} removed, {len(moved)} moved"
+    )
+
+    with transaction.atomic():
+        if len(removed) + len(moved) > 0:
+            VehicleCache.objects.filter(vehicle_id__in=removed + moved).delete()
+        VehicleCache.objects.bulk_create(
+            changed,
+            update_conflicts=True,
+            unique_fields=["vehicle_id"],
+            update_fields=[
+                f.name for f in VehicleCache._meta.concrete_fields if not f.primary_key
+            ],
+        )
+
+    for vehicle_id in removed:
+        persisted_vehicles.pop(vehicle_id)
+    for vc in changed:
+        persisted_vehicles[vc.vehicle_id] = vehicle_state(vc)
+
+
+def delete_stale_vehicles(before: datetime):
+    global stale_before
+
+    stale_before = before
+    VehicleCache.objects.filter(timestamp__lt=before).delete()
+    for vehicle_id, state in list(persisted_vehicles.items()):
+        if state[0] < before:
+            persisted_vehicles.pop(vehicle_id)
+
+
+def init_local(interactive: bool):
+    # for processing records in this process, without workers
+    global vehicle_cache
+
+    guess.init(interactive)
+    vehicle_cache = {}
+
+
+def reset_local():
+    vehicle_cache.clear()
+    vehicle_by_trip.clear()
+
+
+def set_vehicle(vc: VehicleCache):
+    vehicle_cache[vc.vehicle_id] = vc
+    if isinstance(vehicle_queue, ShardedQueue):
+        vehicle_queue.sync(vc.vehicle_id, vc)
+
+
+def pop_vehicle(vehicle_id: int):
+    vehicle_cache.pop(vehicle_id, None)
+    if isinstance(vehicle_queue, ShardedQueue):
+        vehicle_queue.sync(vehicle_id, None)
 
 
 def is_valid(rd: RawVehicleData) -> bool:
@@ -91,7 +239,7 @@ def process_departure(old_vc: VehicleCache, vc: VehicleCache) -> None:
 
     if vst.stoptime.shape_dist_traveled + 20 < vc.shape_dist:  # type: ignore
         vst.departure_time = old_vc.timestamp
-        vst.save()
+        write_buffer.update_vst(vst)
         vc.current_vehiclestoptime = None
 
 
@@ -113,9 +261,9 @@ def process_arrival(old_vc: VehicleCache, new_vc: VehicleCache):
             arrival_time=new_vc.timestamp,
             trip_instance=new_vc.trip_instance,
         )
-        vst.save()
+        write_buffer.add_vst(vst)
         new_vc.current_vehiclestoptime = vst
-        future.estimate_and_save_stoptime_predictions(vst, STRATEGY)
+        write_buffer.add_predictions(vst)
 
     elif (
         old_vc.trip_instance.id is not None
@@ -137,8 +285,8 @@ def process_arrival(old_vc: VehicleCache, new_vc: VehicleCache):
             departure_time=stop_time,
             trip_instance=old_vc.trip_instance,
         )
-        vst.save()
-        future.estimate_and_save_stoptime_predictions(vst, STRATEGY)
+        write_buffer.add_vst(vst)
+        write_buffer.add_predictions(vst)
 
 
 def process_stoptime(vc: VehicleCache) -> VehicleStopTime | None:
@@ -155,10 +303,10 @@ def process_stoptime(vc: VehicleCache) -> VehicleStopTime | None:
 
 def delete(vc: VehicleCache):
     logging.debug(f"delete({vc})")
-    vehicle_cache.pop(vc.vehicle_id, None)
+    pop_vehicle(vc.vehicle_id)
     trip_vc = vehicle_by_trip.get(vc.trip_id)
     if vc.trip_instance.id is not None:
-        vc.trip_instance.delete()
+        write_buffer.delete_trip_instance(vc.trip_instance)
     if trip_vc is not None and trip_vc.vehicle_id == vc.vehicle_id:
         vehicle_by_trip.pop(vc.trip_id, None)
 
@@ -214,12 +362,36 @@ class Context:
         self.invalid.add(vehicle_id)
 
 
+class LocalContext(Context):
+    # processes every record right away in this process
+    def __init__(self):
+        super().__init__(None, None)
+
+    def wait_for(self, vehicle_id: int | None):
+        pass
+
+    def put(self, rd: RawVehicleData):
+        F = f"LocalContext.put({rd})"
+        logging.debug(F)
+
+        vc = process_record(rd, vehicle_cache.get(rd.vehicle_id))
+        self.processed.append(vc)
+        if vc is None:
+            return
+
+        if vc.vehicle_id in self.invalid:
+            self.invalid.remove(vc.vehicle_id)
+            return
+
+        save(self, vc)
+
+
 def save(ctx: Context, vc: VehicleCache):
     F = f"save({vc}):"
     logging.debug(F)
 
     if vc.trip_instance.id is None:
-        vc.trip_instance.save()
+        write_buffer.add_trip_instance(vc.trip_instance)
 
     other = vehicle_by_trip.get(vc.trip_id)
     if other and other.vehicle_id != vc.vehicle_id:
@@ -230,7 +402,7 @@ def save(ctx: Context, vc: VehicleCache):
     old_vc = vehicle_cache.get(vc.vehicle_id)
     if old_vc is not None and old_vc.trip_id != vc.trip_id:
         vehicle_by_trip.pop(old_vc.trip_id, None)
-    vehicle_cache[vc.vehicle_id] = vc
+    set_vehicle(vc)
     vehicle_by_trip[vc.trip_id] = vc
 
     logging.debug(f"{F} vehicle_by_trip[{vc.trip_id}] == {other}")
@@ -262,6 +434,30 @@ def process_new_data(rd: RawVehicleData) -> VehicleCache | None:
     return new_vc
 
 
+def process_record(
+    rd: RawVehicleData, old_vc: VehicleCache | None
+) -> VehicleCache | None:
+    F = f"{os.getpid()}_process_record({rd})"
+    logging.debug(F)
+
+    if not is_valid(rd):
+        logging.debug(f"{F} rd is invalid")
+        return None
+
+    logging.debug(f"{F} old_vc == {old_vc}")
+    if old_vc is not None and (
+        timedelta(0) < rd.timestamp - old_vc.timestamp < timedelta(minutes=5)
+    ):
+        ret = process_updated_data(rd, old_vc)
+    elif old_vc is not None and rd.timestamp == old_vc.timestamp:
+        ret = old_vc
+    else:
+        ret = process_new_data(rd)
+
+    logging.debug(f"{F} ret == {ret}")
+    return ret
+
+
 def _process_raw_data(
     vehicle_queue: "Queue[RawVehicleData]",
     result_queue: "Queue[tuple[int, VehicleCache | None]]",
@@ -269,35 +465,52 @@ def _process_raw_data(
 ) -> None:
     while True:
         rd = vehicle_queue.get()
+        with metrics.timer("worker"):
+            ret = process_record(rd, vehicle_cache.get(rd.vehicle_id))
+        result_queue.put((rd.vehicle_id, ret))
+        metrics.publish()
 
-        F = f"{os.getpid()}_process_raw_data({rd})"
-        logging.debug(F)
 
-        if not is_valid(rd):
-            logging.debug(f"{F} rd is invalid")
-            result_queue.put((rd.vehicle_id, None))
-            continue
+def _process_raw_data_sharded(
+    shard_queue: "Queue[ShardMessage]",
+    result_queue: "Queue[tuple[int, VehicleCache | None]]",
+    shard: int,
+    nshards: int,
+) -> None:
+    vehicle_cache: dict[int, VehicleCache] = {
+        vc.vehicle_id: vc
+        for vc in VehicleCache.objects.all()
+        if shard_of(vc.vehicle_id, nshards) == shard
+    }
 
-        old_vc = vehicle_cache.get(rd.vehicle_id)
-        logging.debug(f"{F} old_vc == {old_vc}")
-        if old_vc is not None and (
-            timedelta(0) < rd.timestamp - old_vc.timestamp < timedelta(minutes=5)
-        ):
-            ret = process_updated_data(rd, old_vc)
-        elif old_vc is not None and rd.timestamp == old_vc.timestamp:
-            ret = old_vc
-        else:
-            ret = process_new_data(rd)
+    while True:
+        message = shard_queue.get()
+        if isinstance(message, tuple):
+            vehicle_id, vc = message
+            if vc is None:
+                vehicle_cache.pop(vehicle_id, None)
+            else:
+                vehicle_cache[vehicle_id] = vc
+            continue
 
-        logging.debug(f"{F} ret == {ret}")
+        rd = message
+        with metrics.timer("worker"):
+            ret = process_record(rd, vehicle_cache.get(rd.vehicle_id))
         result_queue.put((rd.vehicle_id, ret))
+        metrics.publish()
+
 
+def clear_memos():
+    guess.delay_memo.clear()
+    shape_dist_memo.clear()
 
-def process_many_data(rds: Iterable[RawVehicleData]) -> list[VehicleCache | None]:
+
+def process_many_data(rds: list[RawVehicleData]) -> list[VehicleCache | None]:
     F = f"process_many_data(...)"
     logging.debug(F)
 
     ctx = Context(vehicle_queue, result_queue)
+    clear_memos()
 
     for rd in rds:
         logging.debug(f"{F} process {rd}")
@@ -309,17 +522,42 @@ def process_many_data(rds: Iterable[RawVehicleData]) -> list[VehicleCache | None
 
         ctx.put(rd)
 
+    metrics.gauge("vehicle_queue", vehicle_queue.qsize())
+    metrics.gauge("result_queue", result_queue.qsize())
+
     logging.debug(f"{F} finished iterating, waiting for {len(ctx.waiting)}")
-    ctx.wait_for(None)
+    with metrics.timer("wait_for_workers"):
+        ctx.wait_for(None)
+
+    with transaction.atomic():
+        with metrics.timer("write_buffer_flush"):
+            write_buffer.flush(STRATEGY)
+        save_vehicle_cache()
+        mark_processed(rds)
+
+    return ctx.processed
+
+
+def process_many_data_local(
+    rds: list[RawVehicleData],
+) -> list[VehicleCache | None]:
+    # Used by the backfill, which runs many of these in parallel with their
+    # own vehicle state, so the VehicleCache table is left alone.
+    ctx = LocalContext()
+    clear_memos()
+
+    for rd in rds:
+        rd.processed = True
+        ctx.put(rd)
 
     with transaction.atomic():
-        VehicleCache.objects.all().delete()
-        VehicleCache.objects.bulk_create(vehicle_cache.values())
-        RawVehicleData.objects.bulk_update(rds, ["processed"])
+        write_buffer.flush(STRATEGY)
+        mark_processed(rds)
 
     return ctx.processed
 
 
+@metrics.timed("resolve_double_trip")
 def resolve_double_trip(ctx: Context, vc: VehicleCache, exclude_trips: list[Trip] = []):
     F = f"resolve_double_trip({vc}, {exclude_trips})"
     logging.debug(F)
@@ -0,0 +1,91 @@
+import logging
+
+from timepred.models import (
+    StopPrediction,
+    StopTimePrediction,
+    TripInstance,
+    VehicleStopTime,
+)
+from timepred.processing import metrics
+from timepred.processing.bulk import IdAllocator, copy_insert
+from timepred.processing.future import get_stoptime_predictions
+from timepred.processing.future.strategy import EstimationStrategy
+from multigtfs.models.trip import Trip
+
+
+class WriteBuffer:
+    # Collects the writes of one cycle and flushes them in a few bulk
+    # statements. Ids are reserved up front, so buffered objects can be
+    # referenced as if they were saved.
+    def __init__(self):
+        self.trip_instance_ids = IdAllocator(TripInstance)
+        self.vehiclestoptime_ids = IdAllocator(VehicleStopTime)
+        self.trip_instances: dict[int, TripInstance] = {}
+        self.new_vsts: dict[int, VehicleStopTime] = {}
+        self.updated_vsts: dict[int, VehicleStopTime] = {}
+        self.predictions: dict[int, VehicleStopTime] = {}
+        # saved before this cycle, deleted in the same transaction as the
+        # rest is written
+        self.deleted_trip_instance_ids: list[int] = []
+
+    def add_trip_instance(self, ti: TripInstance):
+        ti.id = self.trip_instance_ids.next()
+        self.trip_instances[ti.id] = ti
+
+    def add_vst(self, vst: VehicleStopTime):
+        vst.id = self.vehiclestoptime_ids.next()
+        self.new_vsts[vst.id] = vst
+
+    def update_vst(self, vst: VehicleStopTime):
+        if vst.id in self.new_vsts:
+            self.new_vsts[vst.id] = vst
+        else:
+            self.updated_vsts[vst.id] = vst
+
+    def add_predictions(self, vst: VehicleStopTime):
+        self.predictions[vst.id] = vst
+
+    def delete_trip_instance(self, ti: TripInstance):
+        F = f"WriteBuffer.delete_trip_instance({ti})"
+        logging.debug(F)
+
+        for vsts in [self.new_vsts, self.updated_vsts, self.predictions]:
+            for id, vst in list(vsts.items()):
+                if vst.trip_instance.id == ti.id:
+                    vsts.pop(id)
+
+        if self.trip_instances.pop(ti.id, None) is None:
+            self.deleted_trip_instance_ids.append(ti.id)
+        ti.id = None  # type: ignore
+
+    def flush(self, strategy: EstimationStrategy):
+        F = "WriteBuffer.flush()"
+        logging.debug(
+            f"{F} {len(self.trip_instances)} trip instances, {len(self.deleted_trip_instance_ids)} deleted, {len(self.new_vsts)} new, {len(self.updated_vsts)} updated vsts, {len(self.predictions)} predictions"
+        )
+
+        if len(self.deleted_trip_instance_ids) > 0:
+            TripInstance.objects.filter(id__in=self.deleted_trip_instance_ids).delete()
+
+        copy_insert(list(self.trip_instances.values()))
+        copy_insert(list(self.new_vsts.values()))
+        if len(self.updated_vsts) > 0:
+            VehicleStopTime.objects.bulk_update(
+                list(self.updated_vsts.values()), ["departure_time"]
+            )
+
+        all_sps: list[StopPrediction] = []
+        all_stps: list[StopTimePrediction] = []
+        for vst in self.predictions.values():
+            with metrics.timer("prediction"):
+                sps, stps = get_stoptime_predictions(vst, strategy)
+            all_sps.extend(sps)
+            all_stps.extend(stps)
+        copy_insert(all_sps)
+        copy_insert(all_stps)
+
+        self.trip_instances = {}
+        self.new_vsts = {}
+        self.updated_vsts = {}
+        self.predictions = {}
+        self.deleted_trip_instance_ids = []
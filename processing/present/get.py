@@ -3,17 +3,34 @@ import logging
 
 from django.contrib.gis.geos import Point
 from django.core.cache import cache
-from django.db.models import QuerySet, Q
 import shapely
 from timepred.models import RawVehicleData, VehicleCache
-from timepred.processing.geohelper import remove_closest_segments
-from timepred.processing.constants import WROCLAW_UTM, WSG84
+from timepred.processing import metrics
+from timepred.processing.cache import CycleMemo
+from timepred.processing.geohelper import shape_dist_candidates
+from timepred.processing.projection import get_projected_position
+from timepred.processing.shapes import get_shape_tree, get_trip_shape, shape_key
+from timepred.processing.stoptimes import get_stoptime_table
+from timepred.processing.timetable import get_scheduled_trips
+from timepred.processing.constants import WSG84
 from multigtfs.models.feed import Feed
 from multigtfs.models.route import Route
 from multigtfs.models.stop_time import StopTime
 from multigtfs.models.trip import Trip
 
 
+# shapes farther than that from the vehicle are never matched
+MAX_SHAPE_DISTANCE = 200
+
+
+# candidates of a record on a shape, before filtering on the vehicle state
+shape_dist_memo: CycleMemo[tuple, list[float]] = CycleMemo("shape_dist_memo")
+
+
+def record_key(rd: RawVehicleData) -> tuple:
+    return (rd.pk,) if rd.pk is not None else (rd.vehicle_id, rd.timestamp)
+
+
 def get_position(rd: RawVehicleData) -> Point:
     return Point(rd.longitude, rd.latitude, srid=WSG84)
 
@@ -35,13 +52,10 @@ def get_route_ids():
 
 
 def get_next_stoptime(trip: Trip, shape_dist: float) -> StopTime | None:
-    return (
-        trip.stoptime_set.filter(shape_dist_traveled__gte=shape_dist + 20)
-        .order_by("stop_sequence")
-        .first()
-    )
+    return get_stoptime_table(trip).next_stoptime(shape_dist + 20)
 
 
+@metrics.timed("get_shape_dist")
 def get_shape_dist(trip_or_vc: Trip | VehicleCache, rd: RawVehicleData) -> float | None:
     if isinstance(trip_or_vc, Trip):
         trip = trip_or_vc
@@ -50,86 +64,62 @@ def get_shape_dist(trip_or_vc: Trip | VehicleCache, rd: RawVehicleData) -> float
         trip = trip_or_vc.trip
         vc = trip_or_vc
 
-    shape = trip.geometry.clone()
-    shape.transform(WROCLAW_UTM)
-    shape = shapely.LineString(shape.coords)
-
-    position = get_position(rd)
-    position.transform(WROCLAW_UTM)
-    position = shapely.Point(position.coords)
-
-    def get_shape_dist_rec(shape: shapely.LineString, dist: float) -> float | None:
-        if shape.is_empty:
-            return None
-        if shape.distance(position) > 200:
-            return None
-
-        shape_dist = dist + shape.project(position)
-        possible_shape_dists: list[float] = [shape_dist]
-
-        left, right = remove_closest_segments(shape, position, 200)
-        left_sd = get_shape_dist_rec(left, dist)
-        if left_sd is not None:
-            possible_shape_dists.append(left_sd)
-        if not right.is_empty:
-            right_sd = get_shape_dist_rec(
-                right, dist + shape.project(shapely.Point(right.coords[0]))
-            )
-            if right_sd is not None:
-                possible_shape_dists.append(right_sd)
-
-        if vc is not None:
-            min_dist = vc.shape_dist
-            epsilon = 10
-            possible_shape_dists = [
-                sd for sd in possible_shape_dists if sd >= min_dist - epsilon
-            ]
-        else:
-            min_dist = 0
-
-        if len(possible_shape_dists) == 0:
-            return None
-        return min(possible_shape_dists, key=lambda sd: sd - min_dist)
-
-    return get_shape_dist_rec(shape, 0)
+    possible_shape_dists = shape_dist_memo.get(
+        (shape_key(trip), record_key(rd)),
+        lambda: shape_dist_candidates(
+            get_trip_shape(trip).index,
+            get_projected_position(rd),
+            MAX_SHAPE_DISTANCE,
+            200,
+        ),
+    )
+
+    if vc is not None:
+        min_dist = vc.shape_dist
+        epsilon = 10
+        possible_shape_dists = [
+            sd for sd in possible_shape_dists if sd >= min_dist - epsilon
+        ]
+    else:
+        min_dist = 0
+
+    if len(possible_shape_dists) == 0:
+        return None
+    return min(possible_shape_dists, key=lambda sd: sd - min_dist)
+
+
+def get_near_trips(trips: list[Trip], rd: RawVehicleData) -> list[Trip]:
+    # Leaves out the trips whose shape is too far from the vehicle for
+    # get_shape_dist to find it, without projecting on any of them. Trips
+    # after midnight run on the service day before.
+    day = rd.timestamp.date()
+    trees = [get_shape_tree(day), get_shape_tree(day - datetime.timedelta(days=1))]
+    position = get_projected_position(rd)
+    near = set().union(*(tree.near(position, MAX_SHAPE_DISTANCE) for tree in trees))
+
+    near_trips = []
+    for trip in trips:
+        key = shape_key(trip)
+        # a shape missing from the trees can't be ruled out
+        if key in near or not any(key in tree for tree in trees):
+            near_trips.append(trip)
+
+    metrics.count("near_trips.pruned", len(trips) - len(near_trips))
+    return near_trips
 
 
 def get_active_trips(
     route: Route, rd: RawVehicleData, exclude_trips: list[Trip] = []
-) -> QuerySet[Trip]:
-    active_trips = route.trip_set.filter(
-        brigade_id=rd.brigade_id,
-    ).filter(
-        Q(
-            triptime__start_time__lte=rd.timestamp
-            - rd.timestamp.replace(hour=0, minute=0, second=0),
-            triptime__end_time__gte=rd.timestamp
-            - rd.timestamp.replace(hour=0, minute=0, second=0),
-            service__servicedates__date=rd.timestamp.date(),
-        )
-        | Q(
-            # need to manually convert to int
-            # because the string representation of the interval is "1 day, ..."
-            # and SecondsField expects it to be HH:MM:SS
-            triptime__start_time__lte=int(
-                (
-                    rd.timestamp
-                    - rd.timestamp.replace(hour=0, minute=0, second=0)
-                    + datetime.timedelta(days=1)
-                ).total_seconds()
-            ),
-            triptime__end_time__gte=int(
-                (
-                    rd.timestamp
-                    - rd.timestamp.replace(hour=0, minute=0, second=0)
-                    + datetime.timedelta(days=1)
-                ).total_seconds()
-            ),
-            service__servicedates__date=rd.timestamp.date()
-            - datetime.timedelta(days=1),
-        ),
+) -> list[Trip]:
+    day = rd.timestamp.date()
+    midnight = rd.timestamp.replace(hour=0, minute=0, second=0)
+    seconds = int((rd.timestamp - midnight).total_seconds())
+    today = get_scheduled_trips(route.id, rd.brigade_id, day, seconds)
+    # trips after midnight belong to the service day before
+    yesterday = get_scheduled_trips(
+        route.id, rd.brigade_id, day - datetime.timedelta(days=1), seconds + 86400
     )
+    active_trips = today + yesterday
 
-    if len(exclude_trips) > 0:
-        return active_trips.exclude(id__in=[trip.id for trip in exclude_trips])
-    return active_trips
+    excluded = {trip.id for trip in exclude_trips}
+    return [trip for trip in active_trips if trip.id not in excluded]
@@ -3,19 +3,24 @@ import logging
 from django.db.models import Max, Min
 
 from timepred.models import RawVehicleData, TripInstance, VehicleCache
+from timepred.processing import metrics
+from timepred.processing.cache import CycleMemo
 from multigtfs.models.feed import Feed
 from multigtfs.models.feed_info import FeedInfo
 from multigtfs.models.route import Route
 from multigtfs.models.trip import Trip
 from timepred.processing.present.get import (
     get_active_trips,
+    get_near_trips,
     get_next_stoptime,
     get_position,
     get_shape_dist,
+    record_key,
 )
 from collections import defaultdict
 
 from timepred.processing.present.guess.preprocessing import RouteByDate
+from timepred.processing.timetable import get_successor, get_timetable_trip
 
 
 route_by_date = None
@@ -76,6 +81,12 @@ def guess_trip(
     if len(active_trips) == 1:
         return active_trips[0]
 
+    # no shape_dist, so no delay, on trips passing far from the vehicle
+    active_trips = get_near_trips(list(active_trips), rd)
+    logging.debug(f"{F} near_trips == {active_trips}")
+    if len(active_trips) == 1:
+        return active_trips[0]
+
     trips_with_delay = [
         (trip, delay)
         for trip in active_trips
@@ -91,8 +102,15 @@ def guess_trip(
 
 guess_shape_dist = get_shape_dist
 
+delay_memo: CycleMemo[tuple, timedelta | None] = CycleMemo("delay_memo")
+
 
 def guess_delay(trip: Trip, rd: RawVehicleData) -> timedelta | None:
+    # resolve_double_trip asks again for the same trips and records
+    return delay_memo.get((trip.id, record_key(rd)), lambda: compute_delay(trip, rd))
+
+
+def compute_delay(trip: Trip, rd: RawVehicleData) -> timedelta | None:
     F = f"guess_delay({trip}, {rd})"
     logging.debug(F)
 
@@ -119,31 +137,24 @@ def guess_delay(trip: Trip, rd: RawVehicleData) -> timedelta | None:
 
 
 def guess_next_trip(vc: VehicleCache) -> Trip | None:
-    trip_id = vc.trip.trip_id
-
-    parts = trip_id.split("_")
-    if len(parts) != 2:
-        return None
-
-    try:
-        num_part = int(parts[1])
-    except ValueError:
+    successor = get_successor(vc.route.feed_id, vc.trip_id)  # type: ignore
+    if successor is None:
         return None
-
-    next_num_part = num_part + 1
-    next_trip_id = parts[0] + "_" + str(next_num_part)
-
-    next_trip = Trip.objects.filter(
-        trip_id=next_trip_id, route__feed=vc.trip.route.feed
-    ).first()
-
-    if next_trip is None:
-        return None
-
-    if next_trip.triptime.start_time < vc.trip.triptime.end_time:
-        return None
-
-    return next_trip
+    next_trip_id, _ = successor
+
+    # the next trip runs on the same service day, which may have started
+    # the day before
+    day = vc.timestamp.date()
+    next_trip = get_timetable_trip([day, day - timedelta(days=1)], next_trip_id)
+    if next_trip is not None:
+        return next_trip
+
+    return (
+        Trip.objects.select_related("route", "triptime")
+        .defer("geometry")
+        .filter(id=next_trip_id)
+        .first()
+    )
 
 
 def guess_vehicle_data_after_end_of_trip(
@@ -159,6 +170,7 @@ def guess_vehicle_data_after_end_of_trip(
     return guess_vehicle_data_with_trip(rd, next_trip)
 
 
+@metrics.timed("guess_vehicle_data")
 def guess_vehicle_data(
     rd: RawVehicleData, exclude_trips: list[Trip] = []
 ) -> VehicleCache | None:
@@ -1,13 +1,14 @@
-from collections import defaultdict
 from datetime import date, datetime, time, timedelta
 from dataclasses import dataclass
 
 from django.db.models import Max, Min
 
-from multigtfs.models.feed import Feed
 from multigtfs.models.feed_info import FeedInfo
 from multigtfs.models.route import Route
+from timepred.processing.cache import LRUCache
 from timepred.processing.constants import WROCLAW_TZ
+from timepred.processing.service_calendar import calendar_cache
+from timepred.processing.timetable import timetable_cache
 
 
 @dataclass
@@ -17,84 +18,77 @@ class RouteInfo:
     end_time: datetime
 
 
-RouteByDateDict = dict[date, dict[str, RouteInfo]]
+# start and end of service of every route of a feed, in seconds
+RouteTimes = list[tuple[Route, int, int]]
 
 
 class RouteByDate:
+    # Routes running on a date, resolved lazily. The feed in effect on a
+    # date and the route aggregates of a feed are computed once each, a
+    # date only offsets them.
     def __init__(self, interactive: bool) -> None:
         self.interactive = interactive
+        self.route_by_date: LRUCache[date, dict[str, RouteInfo]] = LRUCache(
+            "route_by_date", 16
+        )
+        self.feed_by_date: LRUCache[date, int | None] = LRUCache("feed_by_date", 64)
+        self.route_times: LRUCache[int, RouteTimes] = LRUCache("route_times", 4)
+        self.prepare()
         if interactive:
-            self.next_update_time = datetime.now()
-        else:
-            self.prepare()
+            self.next_update_time = self.get_next_update_time()
 
     def prepare(self):
-        if self.interactive:
-            self.route_by_date = self.prepare_route_by_date_today()
-        else:
-            self.route_by_date = self.prepare_route_by_date_full()
-
-    def prepare_route_by_date_between(
-        self, start_date: date, end_date: date
-    ) -> RouteByDateDict:
-        rbd: RouteByDateDict = defaultdict(dict)
-        while start_date <= end_date:
-            feed = (
-                Feed.objects.filter(
-                    feedinfo__start_date__lte=start_date,
-                    feedinfo__end_date__gte=start_date,
-                )
-                .order_by("-feedinfo__start_date")
-                .first()
-            )
-            if feed is None:
-                start_date += timedelta(days=1)
-                continue
+        # the service calendar and the timetables are loaded again on first
+        # use, a feed imported by another process does not always bump the
+        # feed generation seen here
+        calendar_cache.clear()
+        timetable_cache.clear()
+
+        self.route_by_date.clear()
+        self.feed_by_date.clear()
+        self.route_times.clear()
+        self.feed_infos = self.get_feed_infos()
+
+    def get_feed_infos(self) -> list[tuple[date, date, int]]:
+        # newest first, as the feed starting last takes precedence
+        return list(
+            FeedInfo.objects.filter(start_date__isnull=False, end_date__isnull=False)
+            .order_by("-start_date")
+            .values_list("start_date", "end_date", "feed_id")
+        )
+
+    def get_feed_id(self, day: date) -> int | None:
+        for start_date, end_date, feed_id in self.feed_infos:
+            if start_date <= day <= end_date:
+                return feed_id
+        return None
 
-            for route in feed.route_set.annotate(
+    def get_route_times(self, feed_id: int) -> RouteTimes:
+        return [
+            (route, route.start_time.seconds, route.end_time.seconds)  # type: ignore
+            for route in Route.objects.filter(feed_id=feed_id).annotate(
                 start_time=Min("trip__triptime__start_time"),
                 end_time=Max("trip__triptime__end_time"),
-            ).all():
-                rbd[start_date][route.route_id] = RouteInfo(
-                    route=route,
-                    start_time=datetime.combine(start_date, time(0, tzinfo=WROCLAW_TZ))
-                    + timedelta(seconds=route.start_time.seconds),  # type: ignore
-                    end_time=datetime.combine(start_date, time(0, tzinfo=WROCLAW_TZ))
-                    + timedelta(seconds=route.end_time.seconds),  # type: ignore
-                )
-
-            start_date += timedelta(days=1)
-
-        return rbd
-
-    def prepare_route_by_date_full(self) -> RouteByDateDict:
-        earliest_feed = (
-            FeedInfo.objects.filter(start_date__isnull=False)
-            .order_by("start_date")
-            .first()
-        )
-        if earliest_feed is None:
-            return {}
-
-        start_date = earliest_feed.start_date
-        assert start_date is not None
+            )
+            if route.start_time is not None  # type: ignore
+        ]
 
-        latest_feed = (
-            FeedInfo.objects.filter(end_date__isnull=False).order_by("end_date").last()
-        )
-        if latest_feed is None:
+    def get_routes(self, day: date) -> dict[str, RouteInfo]:
+        feed_id = self.feed_by_date.get(day, lambda: self.get_feed_id(day))
+        if feed_id is None:
             return {}
 
-        end_date = latest_feed.end_date
-        assert end_date is not None
-
-        return self.prepare_route_by_date_between(start_date, end_date)
-
-    def prepare_route_by_date_today(self) -> RouteByDateDict:
-        today = datetime.now(WROCLAW_TZ).date()
-        return self.prepare_route_by_date_between(
-            today - timedelta(days=2), today + timedelta(days=1)
-        )
+        midnight = datetime.combine(day, time(0, tzinfo=WROCLAW_TZ))
+        return {
+            route.route_id: RouteInfo(
+                route=route,
+                start_time=midnight + timedelta(seconds=start),
+                end_time=midnight + timedelta(seconds=end),
+            )
+            for route, start, end in self.route_times.get(
+                feed_id, lambda: self.get_route_times(feed_id)
+            )
+        }
 
     def get_next_update_time(self):
         return datetime.now() + timedelta(hours=1)
@@ -104,4 +98,6 @@ class RouteByDate:
             self.next_update_time = self.get_next_update_time()
             self.prepare()
 
-        return self.route_by_date.get(date)
+        routes = self.route_by_date.get(date, lambda: self.get_routes(date))
+        # dates without a feed used to be missing
+        return routes if len(routes) > 0 else None
@@ -0,0 +1,49 @@
+from collections.abc import Iterable
+from functools import cache
+
+import numpy as np
+from pyproj import Transformer
+
+from timepred.models import RawVehicleData
+from timepred.processing.constants import WROCLAW_UTM, WSG84
+
+
+@cache
+def get_transformer(source: int, target: int) -> Transformer:
+    # creating a transformer is much more expensive than using it
+    return Transformer.from_crs(source, target, always_xy=True)
+
+
+def transform_coords(coords: np.ndarray, source: int, target: int) -> np.ndarray:
+    # (n, 2) array of x/y (or longitude/latitude) pairs
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    x, y = get_transformer(source, target).transform(coords[:, 0], coords[:, 1])
+    return np.column_stack([x, y])
+
+
+def to_utm(
+    longitude: np.ndarray, latitude: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    return get_transformer(WSG84, WROCLAW_UTM).transform(longitude, latitude)
+
+
+def project_records(rds: Iterable[RawVehicleData]):
+    # Sets x and y in WROCLAW_UTM on every record, in one call for all of
+    # them. They are pickled with the records, so workers get them as well.
+    rds = list(rds)
+    if len(rds) == 0:
+        return
+    x, y = to_utm(
+        np.array([rd.longitude for rd in rds], dtype=np.float64),
+        np.array([rd.latitude for rd in rds], dtype=np.float64),
+    )
+    for rd, rx, ry in zip(rds, x.tolist(), y.tolist()):
+        rd.x = rx  # type: ignore
+        rd.y = ry  # type: ignore
+
+
+def get_projected_position(rd: RawVehicleData) -> tuple[float, float]:
+    # records loaded from the database were not projected at ingest
+    if getattr(rd, "x", None) is None:
+        project_records([rd])
+    return (rd.x, rd.y)  # type: ignore
@@ -0,0 +1,62 @@
+from collections import defaultdict
+from datetime import date
+import logging
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from multigtfs.models.feed import Feed
+from multigtfs.models.service import Service
+from timepred.models import ServiceDay
+from timepred.processing.cache import LRUCache
+
+
+def build_service_calendar(feed: Feed):
+    # Stores the services running on every date of a feed, so that
+    # finding them needs no join over the calendar tables.
+    days: dict[date, set[int]] = defaultdict(set)
+    for day, service_id in Service.objects.filter(
+        feed=feed, servicedates__date__isnull=False
+    ).values_list("servicedates__date", "id"):
+        days[day].add(service_id)
+
+    with transaction.atomic():
+        ServiceDay.objects.filter(feed=feed).delete()
+        ServiceDay.objects.bulk_create(
+            [
+                ServiceDay(feed=feed, date=day, service_ids=sorted(service_ids))
+                for day, service_ids in days.items()
+            ],
+            batch_size=1000,
+        )
+
+    logging.info(f"build_service_calendar({feed}): {len(days)} days")
+
+
+def build_missing_service_calendars() -> int:
+    feeds = list(
+        Feed.objects.filter(~Exists(ServiceDay.objects.filter(feed=OuterRef("pk"))))
+    )
+    for feed in feeds:
+        build_service_calendar(feed)
+    return len(feeds)
+
+
+calendar_cache: LRUCache[date, frozenset[int]] = LRUCache("calendar_cache", 16)
+
+
+def load_active_services(day: date) -> frozenset[int]:
+    rows = list(
+        ServiceDay.objects.filter(date=day).values_list("service_ids", flat=True)
+    )
+    if len(rows) == 0:
+        # feeds imported before the calendar existed
+        return frozenset(
+            Service.objects.filter(servicedates__date=day).values_list("id", flat=True)
+        )
+    return frozenset(service_id for service_ids in rows for service_id in service_ids)
+
+
+def get_active_services(day: date) -> frozenset[int]:
+    # services of every feed running on day
+    return calendar_cache.get(day, lambda: load_active_services(day))
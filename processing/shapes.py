@@ -0,0 +1,203 @@
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from datetime import date
+
+from django.conf import settings
+import numpy as np
+import shapely
+
+from multigtfs.models.trip import Trip
+from timepred.processing.cache import LRUCache
+from timepred.processing.constants import WROCLAW_UTM
+from timepred.processing.patterns import get_pattern
+from timepred.processing.service_calendar import get_active_services
+
+ShapeKey = tuple[str, int | str]
+
+
+class ShapeIndex:
+    # Vertices of a line with the distance along the line of every vertex,
+    # so splitting it needs only a binary search instead of projecting the
+    # vertices back onto the line. The distances may be given in other units
+    # than the coordinates, e.g. metres along the trip shape for a WGS84 line.
+    def __init__(self, coords: np.ndarray, distances: np.ndarray | None = None):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        if distances is None:
+            segment_lengths = np.hypot(*np.diff(self.coords, axis=0).T)
+            distances = np.concatenate([[0.0], np.cumsum(segment_lengths)])
+        self.distances = np.asarray(distances, dtype=np.float64)
+        # bisect on a list is faster than searchsorted for a single value
+        self.distance_list: list[float] = self.distances.tolist()
+
+    @classmethod
+    def from_line(cls, line: shapely.LineString) -> "ShapeIndex":
+        return cls(shapely.get_coordinates(line))
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    @property
+    def length(self) -> float:
+        return self.distance_list[-1] if len(self.distance_list) > 0 else 0.0
+
+    def vertex_at(self, distance: float) -> int:
+        # index of the last vertex at or before distance
+        return max(bisect_right(self.distance_list, distance) - 1, 0)
+
+    def point_at(self, distance: float) -> tuple[float, float]:
+        i = min(self.vertex_at(distance), len(self) - 2)
+        start, end = self.distance_list[i], self.distance_list[i + 1]
+        t = (distance - start) / (end - start) if end > start else 0.0
+        t = min(max(t, 0.0), 1.0)
+        x, y = self.coords[i] + t * (self.coords[i + 1] - self.coords[i])
+        return (float(x), float(y))
+
+    def cut(self, distance: float) -> tuple[shapely.LineString, shapely.LineString]:
+        # Cuts the line in two at a distance from its starting point
+        if distance <= 0.0 or distance >= self.length:
+            return (shapely.LineString([]), shapely.LineString(self.coords))
+
+        i = self.vertex_at(distance)
+        if self.distance_list[i] == distance:
+            return (
+                shapely.LineString(self.coords[: i + 1]),
+                shapely.LineString(self.coords[i:]),
+            )
+        cp = [self.point_at(distance)]
+        return (
+            shapely.LineString(np.concatenate([self.coords[: i + 1], cp])),
+            shapely.LineString(np.concatenate([cp, self.coords[i + 1 :]])),
+        )
+
+    def closest_segments(
+        self, distance: float, gap: float, start: int = 0, end: int | None = None
+    ) -> tuple[int, int]:
+        # Of the vertices [start, end), the ones within gap of distance are
+        # [left, right), where left and right are absolute indices. The
+        # vertex just after distance is always in there.
+        if end is None:
+            end = len(self)
+        middle = min(bisect_right(self.distance_list, distance, start, end), end - 1)
+        left = bisect_right(self.distance_list, distance - gap, start, middle)
+        right = bisect_left(self.distance_list, distance + gap, middle, end)
+        return left, right
+
+    def remove_closest_segments(
+        self, distance: float, gap: float
+    ) -> tuple[shapely.LineString, shapely.LineString]:
+        # What is left of the line on both sides after dropping the segments
+        # within gap of distance
+        n = len(self)
+        left, right = self.closest_segments(distance, gap)
+        empty = shapely.LineString([])
+        return (
+            shapely.LineString(self.coords[:left]) if left > 1 else empty,
+            shapely.LineString(self.coords[right:]) if right < n - 1 else empty,
+        )
+
+
+@dataclass
+class TripShape:
+    # trip geometry in WROCLAW_UTM, prepared
+    line: shapely.LineString
+    index: ShapeIndex
+
+
+shape_cache: LRUCache[ShapeKey, TripShape] = LRUCache(
+    "shape_cache", getattr(settings, "TIMEPRED_SHAPE_CACHE_SIZE", 2048)
+)
+
+
+def shape_key_of(trip_id: int, shape_id: int | None, service_id: int) -> ShapeKey:
+    # trips with the same geometry share it, see build_patterns
+    pattern = get_pattern(trip_id, service_id)
+    if pattern is not None:
+        return ("geometry", pattern[1])
+    if shape_id is not None:
+        return ("shape", shape_id)
+    return ("trip", trip_id)
+
+
+def shape_key(trip: Trip) -> ShapeKey:
+    return shape_key_of(trip.id, trip.shape_id, trip.service_id)  # type: ignore
+
+
+def load_trip_shape(trip: Trip) -> TripShape:
+    geometry = trip.geometry.clone()
+    geometry.transform(WROCLAW_UTM)
+
+    index = ShapeIndex(np.array(geometry.coords, dtype=np.float64))
+    line = shapely.LineString(index.coords)
+    shapely.prepare(line)
+
+    return TripShape(line=line, index=index)
+
+
+def get_trip_shape(trip: Trip) -> TripShape:
+    return shape_cache.get(shape_key(trip), lambda: load_trip_shape(trip))
+
+
+simplified_shape_cache: LRUCache[ShapeKey, TripShape] = LRUCache(
+    "simplified_shape_cache", 256
+)
+
+
+def load_simplified_trip_shape(trip: Trip) -> TripShape:
+    line = get_trip_shape(trip).line.simplify(2, preserve_topology=False)
+    return TripShape(line=line, index=ShapeIndex.from_line(line))
+
+
+def get_simplified_trip_shape(trip: Trip) -> TripShape:
+    # for drawing only, positions are matched on the full shape
+    return simplified_shape_cache.get(
+        shape_key(trip), lambda: load_simplified_trip_shape(trip)
+    )
+
+
+@dataclass
+class ShapeTree:
+    # the shapes of all trips running on a day
+    tree: shapely.STRtree
+    keys: list[ShapeKey]
+
+    def __post_init__(self):
+        self.key_set = set(self.keys)
+
+    def __contains__(self, key: ShapeKey) -> bool:
+        return key in self.key_set
+
+    def near(self, point: tuple[float, float], distance: float) -> set[ShapeKey]:
+        # bounding boxes first, then the exact distance
+        return {
+            self.keys[i]
+            for i in self.tree.query(
+                shapely.Point(point), predicate="dwithin", distance=distance
+            )
+        }
+
+
+shape_tree_cache: LRUCache[date, ShapeTree] = LRUCache("shape_tree_cache", 4)
+
+
+def load_shape_tree(day: date) -> ShapeTree:
+    trips = Trip.objects.filter(
+        service_id__in=get_active_services(day), geometry__isnull=False
+    ).values_list("id", "shape_id", "service_id")
+    # one trip for every shape
+    representatives = {
+        shape_key_of(id, shape_id, service_id): id for id, shape_id, service_id in trips
+    }
+
+    keys = []
+    lines = []
+    for trip in Trip.objects.filter(id__in=representatives.values()).only(
+        "id", "shape_id", "service_id", "geometry"
+    ):
+        keys.append(shape_key(trip))
+        lines.append(get_trip_shape(trip).line)
+
+    return ShapeTree(tree=shapely.STRtree(lines), keys=keys)
+
+
+def get_shape_tree(day: date) -> ShapeTree:
+    return shape_tree_cache.get(day, lambda: load_shape_tree(day))
@@ -0,0 +1,145 @@
+from datetime import date, datetime, timedelta
+import logging
+import os
+import pickle
+
+from django.conf import settings
+from django.db.models import Max
+import shapely
+
+from multigtfs.models.feed import Feed
+from multigtfs.models.feed_info import FeedInfo
+from timepred.processing.cache import LRUCache
+from timepred.processing.constants import WROCLAW_TZ
+from timepred.processing.patterns import pattern_cache
+from timepred.processing.present.guess.preprocessing import RouteByDate
+from timepred.processing.service_calendar import calendar_cache, get_active_services
+from timepred.processing.shapes import get_shape_tree, shape_cache, shape_tree_cache
+from timepred.processing.stoptimes import load_stoptime_tables, stoptime_cache
+from timepred.processing.timetable import (
+    get_successor,
+    get_timetable,
+    successor_cache,
+    timetable_cache,
+)
+
+# The caches derived from feeds, pickled after a feed import and loaded by
+# present.init before the workers fork, so that they start warm instead of
+# filling them one query at a time. A snapshot is only used while the feeds
+# in the database are the ones it was written for. fix_unmonotone_stops
+# rewrites stop times without changing the feeds, so write_snapshot has to
+# be run again after it.
+
+# the snapshot is unpickled at startup, it has to be in a directory only the
+# service can write to, without it there is no warm start
+SNAPSHOT_PATH: str | None = getattr(settings, "TIMEPRED_SNAPSHOT_PATH", None)
+
+CACHES: list[LRUCache] = [
+    pattern_cache,
+    calendar_cache,
+    timetable_cache,
+    successor_cache,
+    shape_cache,
+    shape_tree_cache,
+    stoptime_cache,
+]
+
+
+def get_caches(route_by_date: RouteByDate) -> list[LRUCache]:
+    return CACHES + [
+        route_by_date.route_by_date,
+        route_by_date.feed_by_date,
+        route_by_date.route_times,
+    ]
+
+
+def feed_fingerprint() -> tuple:
+    # read from the database, so that it is the same in every process,
+    # whatever the cache backend
+    return (
+        Feed.objects.aggregate(Max("id"))["id__max"],
+        tuple(
+            FeedInfo.objects.order_by("feed_id").values_list(
+                "feed_id", "start_date", "end_date", "version"
+            )
+        ),
+    )
+
+
+def snapshot_days(today: date) -> list[date]:
+    # trips after midnight run on the service day before
+    return [today - timedelta(days=1), today, today + timedelta(days=1)]
+
+
+def warm_caches(days: list[date], today: date, route_by_date: RouteByDate):
+    for day in days:
+        get_active_services(day)
+        route_by_date.get(day)
+        timetable = get_timetable(day)
+        get_shape_tree(day)
+        for feed_id in {trip.route.feed_id for trip in timetable.trips.values()}:
+            get_successor(feed_id, 0)
+
+    # Stop time tables only of today's trips, in order of their start and no
+    # more than stoptime_cache holds, anything beyond would evict the rest.
+    trip_ids = list(get_timetable(today).trips)
+    if stoptime_cache.maxsize is not None and len(trip_ids) > stoptime_cache.maxsize:
+        logging.warning(
+            f"warm_caches: {len(trip_ids)} trips today, stop times of the first "
+            f"{stoptime_cache.maxsize} kept, see TIMEPRED_STOPTIME_CACHE_SIZE"
+        )
+        trip_ids = trip_ids[: stoptime_cache.maxsize]
+    load_stoptime_tables(trip_ids)
+
+
+def write_snapshot(path: str | None = SNAPSHOT_PATH):
+    if path is None:
+        logging.info("write_snapshot: TIMEPRED_SNAPSHOT_PATH is not set")
+        return
+
+    route_by_date = RouteByDate(False)
+    today = datetime.now(WROCLAW_TZ).date()
+    warm_caches(snapshot_days(today), today, route_by_date)
+
+    snapshot = {
+        "fingerprint": feed_fingerprint(),
+        "caches": {cache.name: cache.items() for cache in get_caches(route_by_date)},
+    }
+
+    # readers never see a partly written file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+    logging.info(f"write_snapshot({path}): {os.path.getsize(path)} bytes")
+
+
+def load_snapshot(route_by_date: RouteByDate, path: str | None = SNAPSHOT_PATH) -> bool:
+    if path is None:
+        logging.info("load_snapshot: TIMEPRED_SNAPSHOT_PATH is not set, no warm start")
+        return False
+
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception:
+        logging.exception(f"load_snapshot({path})")
+        return False
+
+    if snapshot.get("fingerprint") != feed_fingerprint():
+        logging.info(f"load_snapshot({path}): written for other feeds")
+        return False
+
+    caches = get_caches(route_by_date)
+    for cache in caches:
+        cache.load(snapshot["caches"].get(cache.name, []))
+
+    # geometries are not pickled prepared
+    for _, shape in shape_cache.items():
+        shapely.prepare(shape.line)
+
+    logging.info(f"load_snapshot({path}): {', '.join(c.name for c in caches)}")
+    return True
@@ -0,0 +1,100 @@
+from dataclasses import dataclass
+
+from django.conf import settings
+import numpy as np
+
+from multigtfs.models.stop_time import StopTime
+from multigtfs.models.trip import Trip
+from timepred.processing.cache import LRUCache
+
+
+def seconds_or_nan(value) -> float:
+    return value.seconds if value is not None else np.nan
+
+
+@dataclass
+class StopTimeTable:
+    # stop times of a trip in stop_sequence order, with their stops
+    stop_times: list[StopTime]
+    ids: np.ndarray
+    stop_sequences: np.ndarray
+    # nan where missing, so that like NULL it never compares true
+    shape_dists: np.ndarray
+    arrivals: np.ndarray
+    departures: np.ndarray
+
+    def __post_init__(self):
+        # fix_unmonotone_stops leaves almost every trip sorted by shape_dist
+        self.monotone = bool(
+            not np.isnan(self.shape_dists).any()
+            and np.all(np.diff(self.shape_dists) >= 0)
+        )
+
+    def __len__(self) -> int:
+        return len(self.stop_times)
+
+    def next_stoptime(self, shape_dist: float) -> StopTime | None:
+        # first stop time with shape_dist_traveled >= shape_dist
+        if self.monotone:
+            i = int(np.searchsorted(self.shape_dists, shape_dist, "left"))
+        else:
+            after = np.flatnonzero(self.shape_dists >= shape_dist)
+            i = int(after[0]) if len(after) > 0 else len(self)
+        return self.stop_times[i] if i < len(self) else None
+
+    def after(self, stop_sequence: int) -> list[StopTime]:
+        i = int(np.searchsorted(self.stop_sequences, stop_sequence, "right"))
+        return self.stop_times[i:]
+
+
+def make_stoptime_table(stop_times: list[StopTime]) -> StopTimeTable:
+    return StopTimeTable(
+        stop_times=stop_times,
+        ids=np.array([st.id for st in stop_times], dtype=np.int64),
+        stop_sequences=np.array(
+            [st.stop_sequence for st in stop_times], dtype=np.int64
+        ),
+        shape_dists=np.array(
+            [
+                st.shape_dist_traveled if st.shape_dist_traveled is not None else np.nan
+                for st in stop_times
+            ],
+            dtype=np.float64,
+        ),
+        arrivals=np.array(
+            [seconds_or_nan(st.arrival_time) for st in stop_times], dtype=np.float64
+        ),
+        departures=np.array(
+            [seconds_or_nan(st.departure_time) for st in stop_times], dtype=np.float64
+        ),
+    )
+
+
+stoptime_cache: LRUCache[int, StopTimeTable] = LRUCache(
+    "stoptime_cache", getattr(settings, "TIMEPRED_STOPTIME_CACHE_SIZE", 4096)
+)
+
+
+def load_stoptime_table(trip: Trip) -> StopTimeTable:
+    return make_stoptime_table(
+        list(trip.stoptime_set.select_related("stop").order_by("stop_sequence"))
+    )
+
+
+def get_stoptime_table(trip: Trip) -> StopTimeTable:
+    return stoptime_cache.get(trip.id, lambda: load_stoptime_table(trip))
+
+
+def load_stoptime_tables(trip_ids: list[int], chunk_size: int = 1000):
+    # fills the cache for many trips with a query per chunk of trips
+    for i in range(0, len(trip_ids), chunk_size):
+        chunk = trip_ids[i : i + chunk_size]
+        by_trip: dict[int, list[StopTime]] = {trip_id: [] for trip_id in chunk}
+        for st in (
+            StopTime.objects.filter(trip_id__in=chunk)
+            .select_related("stop")
+            .order_by("trip_id", "stop_sequence")
+        ):
+            by_trip[st.trip_id].append(st)  # type: ignore
+        for trip_id, stop_times in by_trip.items():
+            stoptime_cache.set(trip_id, make_stoptime_table(stop_times))
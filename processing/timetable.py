@@ -0,0 +1,137 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from datetime import date
+
+from multigtfs.models.trip import Trip
+from timepred.processing.cache import LRUCache
+from timepred.processing.service_calendar import get_active_services
+
+
+@dataclass
+class BrigadeTrips:
+    # trips of one brigade of a route on a service day, sorted by start
+    trips: list[Trip] = field(default_factory=list)
+    starts: list[int] = field(default_factory=list)
+    ends: list[int] = field(default_factory=list)
+    max_duration: int = 0
+
+    def active(self, seconds: int) -> list[Trip]:
+        # trips with start <= seconds <= end, no trip is longer than
+        # max_duration so only those starting after seconds - max_duration
+        # have to be looked at
+        lower = bisect_left(self.starts, seconds - self.max_duration)
+        upper = bisect_right(self.starts, seconds)
+        return [self.trips[i] for i in range(lower, upper) if self.ends[i] >= seconds]
+
+
+@dataclass
+class Timetable:
+    # trips running on a service day
+    brigades: dict[tuple[int, str], BrigadeTrips]
+    trips: dict[int, Trip]
+
+
+def make_timetable(trips: Iterable[tuple[int, int, Trip]]) -> Timetable:
+    # (start, end, trip) of every trip running on the day
+    rows = sorted(trips, key=lambda row: row[0])
+
+    brigades: dict[tuple[int, str], BrigadeTrips] = defaultdict(BrigadeTrips)
+    for start, end, trip in rows:
+        brigade = brigades[(trip.route_id, str(trip.brigade_id))]  # type: ignore
+        brigade.trips.append(trip)
+        brigade.starts.append(start)
+        brigade.ends.append(end)
+        brigade.max_duration = max(brigade.max_duration, end - start)
+    return Timetable(
+        brigades=dict(brigades), trips={trip.id: trip for _, _, trip in rows}
+    )
+
+
+def load_timetable(day: date) -> Timetable:
+    trips = (
+        Trip.objects.filter(
+            service_id__in=get_active_services(day), triptime__isnull=False
+        )
+        .select_related("route", "triptime")
+        .defer("geometry")
+    )
+    return make_timetable(
+        (trip.triptime.start_time.seconds, trip.triptime.end_time.seconds, trip)
+        for trip in trips
+    )
+
+
+timetable_cache: LRUCache[date, Timetable] = LRUCache("timetable_cache", 4)
+
+
+def get_timetable(day: date) -> Timetable:
+    return timetable_cache.get(day, lambda: load_timetable(day))
+
+
+def get_scheduled_trips(
+    route_id: int, brigade_id: int | str, day: date, seconds: int
+) -> list[Trip]:
+    # brigade ids are compared as strings, like the database would
+    brigade = get_timetable(day).brigades.get((route_id, str(brigade_id)))
+    if brigade is None:
+        return []
+    return brigade.active(seconds)
+
+
+def next_trip_id(trip_id: str) -> str | None:
+    # trips of a brigade are numbered, "<block>_<n>" is followed by "<block>_<n+1>"
+    parts = trip_id.split("_")
+    if len(parts) != 2:
+        return None
+
+    try:
+        num_part = int(parts[1])
+    except ValueError:
+        return None
+
+    return parts[0] + "_" + str(num_part + 1)
+
+
+# trip -> (next trip, its start in seconds), for every trip of a feed that
+# is followed by one starting no earlier than it ends
+Successors = dict[int, tuple[int, int]]
+
+successor_cache: LRUCache[int, Successors] = LRUCache("successor_cache", 4)
+
+
+def find_successors(rows: Iterable[tuple[int, str, int, int]]) -> Successors:
+    # (id, trip_id, start, end) of every trip of a feed
+    trips = {trip_id: (id, start, end) for id, trip_id, start, end in rows}
+
+    successors: Successors = {}
+    for trip_id, (id, _, end) in trips.items():
+        next_id = next_trip_id(trip_id)
+        if next_id is None or next_id not in trips:
+            continue
+        next_pk, next_start, _ = trips[next_id]
+        if next_start >= end:
+            successors[id] = (next_pk, next_start)
+    return successors
+
+
+def load_successors(feed_id: int) -> Successors:
+    return find_successors(
+        (id, trip_id, start.seconds, end.seconds)
+        for id, trip_id, start, end in Trip.objects.filter(
+            route__feed_id=feed_id, triptime__isnull=False
+        ).values_list("id", "trip_id", "triptime__start_time", "triptime__end_time")
+    )
+
+
+def get_successor(feed_id: int, trip_id: int) -> tuple[int, int] | None:
+    return successor_cache.get(feed_id, lambda: load_successors(feed_id)).get(trip_id)
+
+
+def get_timetable_trip(days: list[date], trip_id: int) -> Trip | None:
+    for day in days:
+        trip = get_timetable(day).trips.get(trip_id)
+        if trip is not None:
+            return trip
+    return None
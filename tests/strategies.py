@@ -0,0 +1,39 @@
+import hypothesis.strategies as st
+import numpy as np
+
+coordinates = st.floats(min_value=-2000, max_value=2000, allow_nan=False)
+points = st.tuples(coordinates, coordinates)
+# (length, angle) of every segment of a random walk
+steps = st.tuples(
+    st.floats(min_value=1, max_value=300), st.floats(min_value=0, max_value=6.28)
+)
+
+
+def random_walk(walk: list[tuple[float, float]], back: bool = False) -> np.ndarray:
+    length, angle = np.array(walk).T
+    segments = length[:, None] * np.column_stack([np.cos(angle), np.sin(angle)])
+    if back:
+        # routes that come back the same way, a bit to the side
+        segments = np.concatenate([segments, -segments[::-1] + 0.5])
+    return np.concatenate([[[0.0, 0.0]], np.cumsum(segments, axis=0)])
+
+
+# in steps of 10 minutes, so that trips often start or end exactly then
+times = st.integers(min_value=0, max_value=30 * 6).map(lambda t: t * 600)
+# (start, end) in seconds since the midnight of the service day, trips after
+# midnight go past 86400
+intervals = st.tuples(times, st.integers(min_value=0, max_value=4 * 6)).map(
+    lambda interval: (interval[0], interval[0] + interval[1] * 600)
+)
+
+
+def timed_rows(
+    keys: st.SearchStrategy, max_size: int, unique: bool = True
+) -> st.SearchStrategy[list[tuple]]:
+    # (key, start, end) of trips or routes, as their times are loaded from a
+    # feed, with at most one row per key if unique
+    return st.lists(
+        st.tuples(keys, intervals).map(lambda row: (row[0], *row[1])),
+        max_size=max_size,
+        unique_by=(lambda row: row[0]) if unique else None,
+    )
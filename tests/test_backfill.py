@@ -0,0 +1,71 @@
+import datetime
+from unittest import mock
+
+from django.test import TestCase
+
+from multigtfs.models.feed import Feed
+from multigtfs.models.route import Route
+from multigtfs.models.trip import Trip
+from timepred.models import BackfillCheckpoint, RawVehicleData, TripInstance
+from timepred.processing import backfill
+from timepred.processing.constants import WROCLAW_TZ
+from timepred.processing.partitions import mark_processed
+
+DAY = datetime.date(2024, 1, 20)
+DAY_START_HOUR = 3
+
+
+class RestartTestCase(TestCase):
+    def setUp(self):
+        feed = Feed.objects.create(name="feed")
+        route = Route.objects.create(feed=feed, route_id="105", rtype=3)
+        self.trip = Trip.objects.create(route=route, trip_id="1_1")
+
+        start, _ = backfill.service_day_bounds(DAY, DAY_START_HOUR)
+        RawVehicleData.objects.bulk_create(
+            RawVehicleData(
+                vehicle_id=vehicle_id,
+                route_id="105",
+                route_name="105",
+                brigade_id=1,
+                timestamp=start + datetime.timedelta(hours=hour),
+                latitude=51.1,
+                longitude=17.03,
+            )
+            for vehicle_id in range(3)
+            for hour in range(0, 24, 4)
+        )
+        # made by processing the day before, stays when the day is restarted
+        TripInstance.objects.create(
+            trip=self.trip, started_at=start - datetime.timedelta(minutes=1)
+        )
+
+    def process(self, rds: list[RawVehicleData]) -> list:
+        # one trip instance started by every record
+        TripInstance.objects.bulk_create(
+            TripInstance(trip=self.trip, started_at=rd.timestamp) for rd in rds
+        )
+        for rd in rds:
+            rd.processed = True
+        mark_processed(rds)
+        return rds
+
+    def counts(self) -> tuple[int, int, int]:
+        return (
+            TripInstance.objects.count(),
+            RawVehicleData.objects.filter(processed=True).count(),
+            BackfillCheckpoint.objects.filter(day=DAY, finished=True).count(),
+        )
+
+    def test_restart_replaces_trip_instances(self):
+        with mock.patch.object(
+            backfill.present, "process_many_data_local", self.process
+        ), mock.patch.object(backfill, "project_records"):
+            backfill.backfill_day(DAY, DAY_START_HOUR)
+            first = self.counts()
+
+            backfill.restart_days([DAY], DAY_START_HOUR)
+            assert self.counts() == (1, 0, 0)
+
+            backfill.backfill_day(DAY, DAY_START_HOUR)
+            assert self.counts() == first == (19, 18, 1)
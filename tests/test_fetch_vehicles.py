@@ -0,0 +1,173 @@
+import datetime
+import urllib.parse
+
+from django.test import SimpleTestCase
+import pandas as pd
+
+from timepred.management.commands.fetch_vehicles import (
+    Command,
+    empty_snapshot,
+    merge_snapshots,
+)
+from timepred.processing.constants import WROCLAW_TZ
+
+
+def record(
+    vehicle_id="2301",
+    brigade="10502",
+    route_name="105",
+    latitude="51.1",
+    longitude="17.03",
+    updated_at="2024-01-20 12:00:00",
+) -> dict:
+    return {
+        "Nr_Boczny": vehicle_id,
+        "Brygada": brigade,
+        "Nazwa_Linii": route_name,
+        "Ostatnia_Pozycja_Szerokosc": latitude,
+        "Ostatnia_Pozycja_Dlugosc": longitude,
+        "Data_Aktualizacji": updated_at,
+    }
+
+
+def snapshot(*rows: tuple[int, datetime.datetime, str]) -> pd.DataFrame:
+    # (vehicle_id, timestamp, route_name)
+    return pd.DataFrame(
+        {
+            "route_id": ["105" for _ in rows],
+            "brigade_id": [2 for _ in rows],
+            "route_name": [route_name for _, _, route_name in rows],
+            "latitude": [51.1 for _ in rows],
+            "longitude": [17.03 for _ in rows],
+            "timestamp": pd.to_datetime(
+                [timestamp for _, timestamp, _ in rows]
+            ).tz_convert(WROCLAW_TZ),
+        },
+        index=pd.Index([vehicle_id for vehicle_id, _, _ in rows], name="vehicle_id"),
+    )
+
+
+def command(watermark: str | None = None) -> Command:
+    command = Command()
+    command.watermark = watermark
+    return command
+
+
+class ParseRecordsTestCase(SimpleTestCase):
+    def test_parses_columns(self):
+        parsed = command().parse_records([record()])
+
+        assert parsed.index.tolist() == [2301]
+        row = parsed.iloc[0]
+        assert row["route_id"] == "105"
+        assert row["brigade_id"] == 2
+        assert row["route_name"] == "105"
+        assert row["latitude"] == 51.1
+        assert row["longitude"] == 17.03
+        assert row["timestamp"] == datetime.datetime(2024, 1, 20, 12, tzinfo=WROCLAW_TZ)
+
+    def test_iso8601_timestamps(self):
+        parsed = command().parse_records(
+            [
+                record(vehicle_id="1", updated_at="2024-01-20T12:00:00"),
+                record(vehicle_id="2", updated_at="2024-01-20 12:00:00.250000"),
+                record(vehicle_id="3", updated_at="2024-01-20"),
+            ]
+        )
+
+        assert parsed.loc[1, "timestamp"] == datetime.datetime(
+            2024, 1, 20, 12, tzinfo=WROCLAW_TZ
+        )
+        assert parsed.loc[2, "timestamp"] == datetime.datetime(
+            2024, 1, 20, 12, 0, 0, 250000, tzinfo=WROCLAW_TZ
+        )
+        assert parsed.loc[3, "timestamp"] == datetime.datetime(
+            2024, 1, 20, tzinfo=WROCLAW_TZ
+        )
+
+    def test_drops_invalid_records(self):
+        parsed = command().parse_records(
+            [
+                record(vehicle_id="1"),
+                record(vehicle_id="not a number"),
+                record(vehicle_id="3", brigade="105xx"),
+                record(vehicle_id="4", updated_at="yesterday"),
+                record(vehicle_id="5", updated_at=None),
+            ]
+        )
+
+        assert parsed.index.tolist() == [1]
+
+    def test_keeps_newest_record_of_vehicle(self):
+        parsed = command().parse_records(
+            [
+                record(route_name="a", updated_at="2024-01-20 12:00:10"),
+                record(route_name="b", updated_at="2024-01-20 12:00:20"),
+                record(route_name="c", updated_at="2024-01-20 12:00:00"),
+            ]
+        )
+
+        assert parsed["route_name"].tolist() == ["b"]
+
+    def test_updates_watermark(self):
+        c = command("2024-01-20 12:00:15")
+        c.parse_records(
+            [
+                record(vehicle_id="1", updated_at="2024-01-20 12:00:10"),
+                record(vehicle_id="2", updated_at="2024-01-20 12:00:20"),
+            ]
+        )
+        assert c.watermark == "2024-01-20 12:00:20"
+
+        c.parse_records([record(updated_at="2024-01-20 12:00:05")])
+        assert c.watermark == "2024-01-20 12:00:20"
+
+
+class MergeSnapshotsTestCase(SimpleTestCase):
+    t = datetime.datetime(2024, 1, 20, 12, tzinfo=WROCLAW_TZ)
+
+    def test_newest_record_wins(self):
+        older = snapshot((1, self.t, "a"), (2, self.t + datetime.timedelta(1), "a"))
+        newer = snapshot((1, self.t + datetime.timedelta(1), "b"), (2, self.t, "b"))
+
+        merged = merge_snapshots(older, newer)
+
+        assert merged.sort_index()["route_name"].tolist() == ["b", "a"]
+
+    def test_newer_snapshot_wins_ties(self):
+        merged = merge_snapshots(snapshot((1, self.t, "a")), snapshot((1, self.t, "b")))
+
+        assert merged["route_name"].tolist() == ["b"]
+
+    def test_empty(self):
+        merged = merge_snapshots(empty_snapshot(), snapshot((1, self.t, "a")))
+
+        assert merged.index.tolist() == [1]
+
+
+class GetUpdatedDataTestCase(SimpleTestCase):
+    def test_updated_data(self):
+        now = datetime.datetime.now(WROCLAW_TZ)
+        old = snapshot(
+            (1, now - datetime.timedelta(seconds=10), "a"),
+            (2, now - datetime.timedelta(seconds=10), "a"),
+            (3, now - datetime.timedelta(minutes=20), "a"),
+        )
+        new = snapshot(
+            # fetched again at the watermark
+            (1, now - datetime.timedelta(seconds=10), "a"),
+            (2, now, "b"),
+            (3, now - datetime.timedelta(minutes=10), "b"),
+            (4, now - datetime.timedelta(minutes=10), "b"),
+        )
+
+        updated = command().get_updated_data(old, new)
+
+        # new vehicles are taken even when their record is old
+        assert sorted(updated.index.tolist()) == [2, 4]
+
+    def test_incremental_url_includes_watermark(self):
+        url = command("2024-01-20 12:00:00").get_incremental_url()
+        sql = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)["sql"][0]
+
+        assert """"Data_Aktualizacji" >= '2024-01-20 12:00:00'""" in sql
@@ -0,0 +1,135 @@
+from django.test import SimpleTestCase
+from hypothesis import assume, given
+import hypothesis.strategies as st
+import numpy as np
+import shapely
+
+from timepred.processing.geohelper import (
+    find_monotone_shape_dists,
+    project_on_segments,
+    shape_dist_candidates,
+)
+from timepred.processing.shapes import ShapeIndex
+from timepred.tests.strategies import points, random_walk, steps
+
+
+def remove_closest_segments_projected(
+    shape: shapely.LineString, point: shapely.Point, dist: float
+) -> tuple[shapely.LineString, shapely.LineString]:
+    # geohelper.remove_closest_segments before it was moved onto ShapeIndex,
+    # kept here so that the recursive search stays as it was
+    distance = shape.project(point)
+    max_dist_left = distance - dist
+    min_dist_right = distance + dist
+    empty = shapely.LineString([])
+
+    coords = list(shape.coords)
+    left = 0
+    N = len(coords)
+    right = N - 1
+    while left != right:
+        middle = (left + right) // 2
+        mp = coords[middle]
+        md = shape.project(shapely.Point(mp))
+        if md <= distance:
+            left = middle + 1
+        else:
+            right = middle
+
+    while left >= 1:
+        ld = shape.project(shapely.Point(coords[left - 1]))
+        if max_dist_left < ld:
+            left -= 1
+        else:
+            break
+
+    while right < N:
+        rd = shape.project(shapely.Point(coords[right]))
+        if rd < min_dist_right:
+            right += 1
+        else:
+            break
+
+    return (
+        shapely.LineString(coords[:left]) if left > 1 else empty,
+        shapely.LineString(coords[right:]) if right < N - 1 else empty,
+    )
+
+
+def shape_dist_candidates_recursive(
+    shape: shapely.LineString, position: shapely.Point, threshold: float, gap: float
+) -> list[float]:
+    # the recursive search shape_dist_candidates replaced
+    def rec(shape: shapely.LineString, dist: float) -> list[float]:
+        if shape.is_empty or shape.distance(position) > threshold:
+            return []
+
+        sd = dist + shape.project(position)
+        left, right = remove_closest_segments_projected(shape, position, gap)
+        left_sd = rec(left, dist)
+        right_sd = (
+            []
+            if right.is_empty
+            else rec(right, dist + shape.project(shapely.Point(right.coords[0])))
+        )
+        return [sd] + left_sd + right_sd
+
+    return rec(shape, 0)
+
+
+class ShapeDistCandidatesTestCase(SimpleTestCase):
+    @given(
+        walk=st.lists(steps, min_size=1, max_size=50),
+        point=points,
+        back=st.booleans(),
+        gap=st.sampled_from([0, 200]),
+    )
+    def test_same_as_recursive(self, walk, point, back, gap):
+        shape = random_walk(walk, back)
+        index = ShapeIndex(shape)
+        line = shapely.LineString(shape)
+
+        # which of two equally close segments is taken first is arbitrary,
+        # and so is the side of a vertex both of its segments are closest at
+        dist, _ = project_on_segments(index, point)
+        near = dist[dist <= 200]
+        ties = np.abs(near[:, None] - near[None, :]) < 1e-9
+        assume(ties.sum() == len(near))
+
+        expected = shape_dist_candidates_recursive(line, shapely.Point(point), 200, gap)
+        actual = shape_dist_candidates(index, point, 200, gap)
+
+        # find_monotone_shape_dists prefers earlier candidates, so the order
+        # matters as much as the values
+        assert len(actual) == len(expected)
+        assert np.allclose(actual, expected, atol=1e-6)
+
+
+def find_monotone_shape_dists_backtracking(
+    candidates: list[list[float]],
+) -> list[float] | None:
+    # the search find_monotone_shape_dists replaced
+    def rec(i: int, alpha: float) -> list[float] | None:
+        if i == len(candidates):
+            return []
+        for sd in candidates[i]:
+            if sd < alpha:
+                continue
+            if (rest := rec(i + 1, sd)) is not None:
+                return [sd] + rest
+        return None
+
+    return rec(0, 0)
+
+
+class FindMonotoneShapeDistsTestCase(SimpleTestCase):
+    @given(
+        candidates=st.lists(
+            st.lists(st.integers(min_value=0, max_value=20).map(float), max_size=4),
+            max_size=8,
+        )
+    )
+    def test_same_as_backtracking(self, candidates):
+        assert find_monotone_shape_dists(
+            candidates
+        ) == find_monotone_shape_dists_backtracking(candidates)
@@ -0,0 +1,30 @@
+from django.test import SimpleTestCase
+from hypothesis import given
+import hypothesis.strategies as st
+import numpy as np
+import shapely
+
+from timepred.processing.shapes import ShapeIndex
+from timepred.tests.strategies import random_walk, steps
+
+
+class ShapeIndexTestCase(SimpleTestCase):
+    @given(
+        walk=st.lists(steps, min_size=1, max_size=50),
+        fraction=st.floats(min_value=0, max_value=1),
+    )
+    def test_cut(self, walk, fraction):
+        shape = random_walk(walk)
+        index = ShapeIndex(shape)
+        line = shapely.LineString(shape)
+        distance = index.length * fraction
+
+        left, right = index.cut(distance)
+
+        if 0 < distance < index.length:
+            assert np.isclose(left.length, distance)
+            assert np.isclose(right.length, line.length - distance)
+            assert left.coords[-1] == right.coords[0]
+        else:
+            assert left.is_empty
+            assert right.equals(line)
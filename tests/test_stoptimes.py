@@ -0,0 +1,39 @@
+from django.test import SimpleTestCase
+from hypothesis import given
+import hypothesis.strategies as st
+import numpy as np
+
+from timepred.processing.stoptimes import StopTimeTable
+
+
+def stoptime_table(shape_dists: list[float]) -> StopTimeTable:
+    n = len(shape_dists)
+    return StopTimeTable(
+        stop_times=list(range(n)),  # type: ignore
+        ids=np.arange(n),
+        stop_sequences=np.arange(n),
+        shape_dists=np.array(shape_dists, dtype=np.float64),
+        arrivals=np.zeros(n),
+        departures=np.zeros(n),
+    )
+
+
+class StopTimeTableTestCase(SimpleTestCase):
+    @given(
+        shape_dists=st.lists(
+            st.one_of(st.just(np.nan), st.floats(min_value=0, max_value=1000)),
+            max_size=20,
+        ),
+        shape_dist=st.floats(min_value=-10, max_value=1010),
+        sort=st.booleans(),
+    )
+    def test_next_stoptime(self, shape_dists, shape_dist, sort):
+        if sort:
+            shape_dists = sorted(sd for sd in shape_dists if not np.isnan(sd))
+        table = stoptime_table(shape_dists)
+
+        # what filtering on shape_dist_traveled returned
+        expected = next(
+            (i for i, sd in enumerate(shape_dists) if sd >= shape_dist), None
+        )
+        assert table.next_stoptime(shape_dist) == expected
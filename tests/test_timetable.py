@@ -0,0 +1,233 @@
+import datetime
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+from hypothesis import given
+import hypothesis.strategies as st
+
+from timepred.processing.constants import WROCLAW_TZ
+from timepred.processing.present.get import get_active_trips
+from timepred.processing.present.guess.preprocessing import RouteByDate
+from timepred.processing.timetable import (
+    BrigadeTrips,
+    find_successors,
+    make_timetable,
+    next_trip_id,
+    timetable_cache,
+)
+from timepred.tests.strategies import intervals, timed_rows, times
+
+DAY = datetime.date(2024, 1, 20)
+
+# (route_id, brigade_id, service days) of trips, any number of them each
+trips = timed_rows(
+    st.tuples(
+        st.sampled_from([1, 2]),
+        st.sampled_from([1, 2]),
+        st.frozensets(st.sampled_from([DAY - datetime.timedelta(days=1), DAY])),
+    ),
+    max_size=30,
+    unique=False,
+)
+
+
+class BrigadeTripsTestCase(SimpleTestCase):
+    @given(
+        intervals=st.lists(intervals, max_size=30),
+        seconds=times,
+    )
+    def test_active(self, intervals, seconds):
+        brigade = BrigadeTrips()
+        for i, (start, end) in sorted(enumerate(intervals), key=lambda t: t[1][0]):
+            brigade.trips.append(i)  # type: ignore
+            brigade.starts.append(start)
+            brigade.ends.append(end)
+            brigade.max_duration = max(brigade.max_duration, end - start)
+
+        expected = [
+            i for i, (start, end) in enumerate(intervals) if start <= seconds <= end
+        ]
+        assert sorted(brigade.active(seconds)) == expected  # type: ignore
+
+
+def get_active_trips_query(rows: list[tuple], route_id: int, rd) -> list[int]:
+    # what the query get_active_trips replaced returned, one row for every
+    # service date that matched
+    midnight = rd.timestamp.replace(hour=0, minute=0, second=0)
+    seconds = int((rd.timestamp - midnight).total_seconds())
+    day = rd.timestamp.date()
+
+    ids = []
+    for i, ((trip_route_id, brigade_id, days), start, end) in enumerate(rows):
+        if trip_route_id != route_id or brigade_id != rd.brigade_id:
+            continue
+        if day in days and start <= seconds <= end:
+            ids.append(i)
+        if day - datetime.timedelta(days=1) in days and start <= seconds + 86400 <= end:
+            ids.append(i)
+    return ids
+
+
+class ActiveTripsTestCase(SimpleTestCase):
+    @given(
+        rows=trips,
+        route_id=st.sampled_from([1, 2]),
+        brigade_id=st.sampled_from([1, 2]),
+    )
+    def test_same_as_query(self, rows, route_id, brigade_id):
+        timetable_cache.clear()
+        for day in [DAY - datetime.timedelta(days=1), DAY]:
+            timetable_cache.set(
+                day,
+                make_timetable(
+                    (start, end, SimpleNamespace(id=i, route_id=r, brigade_id=b))
+                    for i, ((r, b, days), start, end) in enumerate(rows)
+                    if day in days
+                ),  # type: ignore
+            )
+
+        midnight = datetime.datetime.combine(DAY, datetime.time(tzinfo=WROCLAW_TZ))
+        for seconds in range(0, 86400, 600):
+            rd = SimpleNamespace(
+                timestamp=midnight + datetime.timedelta(seconds=seconds),
+                brigade_id=brigade_id,
+            )
+
+            actual = get_active_trips(SimpleNamespace(id=route_id), rd)  # type: ignore
+
+            assert sorted(t.id for t in actual) == sorted(
+                get_active_trips_query(rows, route_id, rd)
+            )
+
+
+# (first day, number of days) of every feed, none starting on the same day
+feeds = st.lists(
+    st.tuples(st.integers(min_value=-10, max_value=10), st.integers(0, 10)),
+    max_size=5,
+    unique_by=lambda feed: feed[0],
+)
+# (route_id, start, end) of the routes of a feed
+feed_routes = timed_rows(st.sampled_from(["A", "1", "105"]), max_size=3)
+
+
+class FixtureRouteByDate(RouteByDate):
+    # RouteByDate over feeds given in place of the database
+    def __init__(self, feed_infos, route_times):
+        self.fixture_feed_infos = feed_infos
+        self.fixture_route_times = route_times
+        super().__init__(False)
+
+    def get_feed_infos(self):
+        # like ORDER BY start_date DESC
+        return sorted(self.fixture_feed_infos, key=lambda info: info[0], reverse=True)
+
+    def get_route_times(self, feed_id):
+        return [
+            (SimpleNamespace(route_id=route_id), start, end)
+            for route_id, start, end in self.fixture_route_times[feed_id]
+        ]
+
+
+def route_by_date_query(feed_infos, route_times, day):
+    # what the per-date query RouteByDate replaced built for a day
+    feed = next(
+        (
+            feed_id
+            for start_date, end_date, feed_id in sorted(feed_infos, reverse=True)
+            if start_date <= day <= end_date
+        ),
+        None,
+    )
+    if feed is None or len(route_times[feed]) == 0:
+        return None
+
+    midnight = datetime.datetime.combine(day, datetime.time(0, tzinfo=WROCLAW_TZ))
+    return {
+        route_id: (
+            midnight + datetime.timedelta(seconds=start),
+            midnight + datetime.timedelta(seconds=end),
+        )
+        for route_id, start, end in route_times[feed]
+    }
+
+
+class RouteByDateTestCase(SimpleTestCase):
+    @given(feeds=feeds, data=st.data())
+    def test_same_as_query(self, feeds, data):
+        feed_infos = [
+            (
+                DAY + datetime.timedelta(days=start),
+                DAY + datetime.timedelta(days=start + length),
+                feed_id,
+            )
+            for feed_id, (start, length) in enumerate(feeds)
+        ]
+        route_times = [data.draw(feed_routes) for _ in feeds]
+        route_by_date = FixtureRouteByDate(feed_infos, route_times)
+
+        for offset in range(-12, 22):
+            day = DAY + datetime.timedelta(days=offset)
+            routes = route_by_date.get(day)
+
+            actual = (
+                None
+                if routes is None
+                else {
+                    route_id: (info.start_time, info.end_time)
+                    for route_id, info in routes.items()
+                }
+            )
+            assert actual == route_by_date_query(feed_infos, route_times, day)
+
+
+class NextTripIdTestCase(SimpleTestCase):
+    def test_next_trip_id(self):
+        assert next_trip_id("3_12") == "3_13"
+        assert next_trip_id("3_09") == "3_10"
+        assert next_trip_id("3") is None
+        assert next_trip_id("3_1_2") is None
+        assert next_trip_id("3_x") is None
+
+
+trip_ids = st.one_of(
+    st.tuples(st.sampled_from(["1", "2", "x"]), st.integers(0, 5)).map(
+        lambda t: f"{t[0]}_{t[1]}"
+    ),
+    st.sampled_from(["1", "1_2_3", "1_x", "1_01"]),
+)
+# (trip_id, start, end) of the trips of a feed
+feed_trips = timed_rows(trip_ids, max_size=20)
+
+
+def guess_next_trip_query(
+    rows: list[tuple[int, str, int, int]], trip: tuple[int, str, int, int]
+) -> tuple[int, int] | None:
+    # what the query guess_next_trip replaced found for trip
+    _, trip_id, _, end = trip
+    parts = trip_id.split("_")
+    if len(parts) != 2:
+        return None
+    try:
+        num_part = int(parts[1])
+    except ValueError:
+        return None
+
+    next_trip = next(
+        (row for row in rows if row[1] == parts[0] + "_" + str(num_part + 1)), None
+    )
+    if next_trip is None or next_trip[2] < end:
+        return None
+    return next_trip[0], next_trip[2]
+
+
+class SuccessorsTestCase(SimpleTestCase):
+    @given(trips=feed_trips)
+    def test_same_as_query(self, trips):
+        rows = [
+            (id, trip_id, start, end) for id, (trip_id, start, end) in enumerate(trips)
+        ]
+
+        successors = find_successors(rows)
+
+        for row in rows:
+            assert successors.get(row[0]) == guess_next_trip_query(rows, row)
@@ -8,4 +8,5 @@ urlpatterns = [
     path("details", views.details),
     path("history", views.history),
     path("stop", views.stop),
+    path("metrics", views.metrics),
 ]
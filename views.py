@@ -1,9 +1,10 @@
 import datetime
 
-import shapely
 from multigtfs.models.stop import Stop
-from timepred.processing.constants import WROCLAW_TZ, WROCLAW_UTM, WSG84
-from timepred.processing.geohelper import cut
+from timepred.processing import metrics as pipeline_metrics
+from timepred.processing.constants import WROCLAW_TZ, WSG84
+from timepred.processing.display import get_display_geometry
+from timepred.processing.service_calendar import get_active_services
 from timepred.processing.present.get import get_position, get_route_ids
 from django.contrib.gis.geos import LineString, Point
 from django.core.serializers.json import DjangoJSONEncoder
@@ -48,6 +49,10 @@ def vehicles(request):
     return JsonResponse(vehicles, safe=False, encoder=FlippedCoordsEncoder)
 
 
+def metrics(request):
+    return JsonResponse(pipeline_metrics.collect(), safe=False)
+
+
 def history(request):
     start_time = request.GET.get("startTime")
     if start_time is None:
@@ -102,7 +107,7 @@ def stop(request):
             ),
         ),
         stop__code=stop_code,
-        trip__service__servicedates__date=now.date(),
+        trip__service_id__in=get_active_services(now.date()),
     )
 
     if len(stoptimes) == 0:
@@ -183,20 +188,10 @@ def details(request):
     if trip is None or trip_instance is None:
         return JsonResponse({}, safe=False)
 
-    geometry = trip.geometry
-    geometry.transform(WROCLAW_UTM)
-    geometry_simpl = geometry.simplify(2)
-
-    vehicle.position.transform(WROCLAW_UTM)
-    simpl_dist = geometry_simpl.project(vehicle.position)
-    prev, next = cut(shapely.LineString(geometry_simpl), simpl_dist)
-    prev = LineString(list(prev.coords), srid=WROCLAW_UTM)
-    next = LineString(list(next.coords), srid=WROCLAW_UTM)
-    prev.transform(WSG84)
-    next.transform(WSG84)
-
-    geometry_simpl.transform(WSG84)
-    shape_simpl = geometry_simpl
+    display = get_display_geometry(trip)
+    prev, next = display.index.cut(vehicle.shape_dist)
+    prev = LineString(list(prev.coords), srid=WSG84)
+    next = LineString(list(next.coords), srid=WSG84)
 
     stop_times: QuerySet[StopTime] = trip.stoptime_set.select_related("stop").order_by(
         "stop_sequence"
@@ -249,13 +244,11 @@ def details(request):
     for st, ets in estimated_times.items():
         stop_times_with_real[st].estimated_times = ets
 
-    pos = geometry.interpolate(vehicle.shape_dist)
-    pos.transform(WSG84)
+    pos = Point(display.index.point_at(vehicle.shape_dist), srid=WSG84)
 
-    proj: dict[StopTime, Point] = {}
-    for st in stop_times:
-        proj[st] = geometry.interpolate(st.shape_dist_traveled)
-        proj[st].transform(WSG84)
+    proj: dict[StopTime, Point] = {
+        st: Point(coords, srid=WSG84) for st, coords in zip(stop_times, display.stops)
+    }
 
     details = {
         "stop_times": stop_times_with_real,